@@ -1,9 +1,17 @@
 import os
 import re
+import json
+import time
+import hashlib
+import shutil
 import string
 import random
+import tempfile
 import numpy as np
 import pandas as pd
+import h5py
+import multiprocess as mp
+import pybedtools
 from pybedtools import BedTool
 from Bio import SeqIO
 import warnings
@@ -15,8 +23,20 @@ warnings.filterwarnings("ignore")
 logging.config.fileConfig('logging.ini', disable_existing_loggers=False)
 logger = logging.getLogger(__name__)
 
+## Byte lookup table of DNA alphabet indices (A, C, G, T), -1 for others
+DNA_ALPHABET = 'ACGT'
+DNA_LOOKUP_TABLE = np.full(256, -1, dtype=np.int8)
+DNA_LOOKUP_TABLE[np.frombuffer(DNA_ALPHABET.encode(), dtype=np.uint8)] = np.arange(4)
+DNA_LOOKUP_TABLE[np.frombuffer(DNA_ALPHABET.lower().encode(), dtype=np.uint8)] = np.arange(4)
+## Number of regulatory regions encoded at once
+DNA_BATCH_REGIONS = 5000
+## Inputs shared by peak track workers
+PEAK_TRACK_STATE = {}
+## MD5 checksums of source files, keyed by (path, size, mtime)
+SOURCE_MD5_CACHE = {}
 
-def intersect_peak_regdna(peak_bed, regdna_bed, gene_df):
+
+def intersect_peak_regdna(peak_bed, regdna_bed, gene_df, backend='bedtools'):
     """Intersect peaks and regulatory DNA to obtain signals within the 
     regulatory regions. The relative start and end of each peak is based
     off gene start (if + strand) or gene stop (if - strand). Negative value
@@ -24,7 +44,8 @@ def intersect_peak_regdna(peak_bed, regdna_bed, gene_df):
     Args:
         peak_bed    - Feature peaks in bed object
         regdna_bed  - Regulatory DNA (region) in bed object
-        gene_df    - Gene annotation
+        gene_df     - Gene annotation
+        backend     - Intersection by `bedtools` or sorted intervals in `numpy`
     Returns:
         Dataframe of peaks assigned to regulatory regions
     """
@@ -36,72 +57,263 @@ def intersect_peak_regdna(peak_bed, regdna_bed, gene_df):
         'peak_chr', 'peak_start', 'peak_end', 'peak_score', 
         'gene', 'strand', 'rel_start', 'rel_end']
 
-    inter_bed = peak_bed.intersect(regdna_bed, wb=True)
-    inter_df = pd.DataFrame(data=inter_bed.to_dataframe().values, columns=INTER_COLS)
-    gene_df = gene_df.rename(columns={
+    if backend == 'numpy':
+        inter_df = intersect_peak_regdna_numpy(
+            peak_bed.to_dataframe(), regdna_bed.to_dataframe())
+        inter_df.columns = INTER_COLS
+    else:
+        inter_bed = peak_bed.intersect(regdna_bed, wb=True)
+        inter_df = pd.DataFrame(data=inter_bed.to_dataframe().values, columns=INTER_COLS)
+    gene_df = drop_duplicate_genes(gene_df).rename(columns={
         'name': 'gene', 'start': 'gene_start', 'end': 'gene_end'})
     inter_df = inter_df.merge(
         gene_df[['gene', 'gene_start', 'gene_end']], how='left', on='gene')
 
     ## Calculate the relative positions of peaks to the gene start. 
-    out_df = pd.DataFrame(columns=OUT_COLS)
-    for strand, subdf in inter_df.groupby('strand'):
-        if strand == '+':
-            subdf['rel_start'] = subdf['peak_start'] - subdf['gene_start']
-            subdf['rel_end'] = subdf['peak_end'] - subdf['gene_start']
-        elif strand == '-':
-            subdf['rel_start'] = subdf['gene_end'] - subdf['peak_end'] 
-            subdf['rel_end'] = subdf['gene_end'] - subdf['peak_start']
-        else:
-            logger.warning('WARNING: {} does not have strand info. Skipped.'.format(
-                np.unique(subdf['gene'])))
-            continue
-        out_df = out_df.append(subdf[OUT_COLS], ignore_index=True)
-    return out_df
-
-
-def create_regdna(gene_bed, genome_fa, reg_bound=(500, 500)):
+    strands = inter_df['strand'].values
+    is_plus, is_minus = strands == '+', strands == '-'
+    if not np.all(is_plus | is_minus):
+        logger.warning('WARNING: {} does not have strand info. Skipped.'.format(
+            np.unique(inter_df.loc[~(is_plus | is_minus), 'gene'])))
+    peak_start, peak_end = inter_df['peak_start'].values, inter_df['peak_end'].values
+    gene_start, gene_end = inter_df['gene_start'].values, inter_df['gene_end'].values
+    inter_df['rel_start'] = np.where(is_plus, peak_start - gene_start, gene_end - peak_end)
+    inter_df['rel_end'] = np.where(is_plus, peak_end - gene_start, gene_end - peak_start)
+    return inter_df.loc[is_plus | is_minus, OUT_COLS].reset_index(drop=True)
+
+
+def intersect_peak_regdna_numpy(peak_df, regdna_df):
+    """Intersect peaks and regulatory DNA without bedtools, in the same output
+    format as `bedtools intersect -wb`, i.e. the overlapping part of each peak
+    followed by the regulatory region, ordered by peak.
+    Args:
+        peak_df     - Peaks in dataframe of bed columns (chrom, start, end, 
+                    name, score)
+        regdna_df   - Regulatory DNA in dataframe of bed columns (chrom, start,
+                    end, name, score, strand)
+    Returns:
+        Dataframe of 5 peak columns and 6 region columns
+    """
+    peak_df = peak_df.iloc[:, :5]
+    regdna_df = regdna_df.iloc[:, :6]
+    peak_idx, reg_idx = RegDNAIndex(regdna_df).find_overlaps(
+        peak_df.iloc[:, 0].values, peak_df.iloc[:, 1].values, peak_df.iloc[:, 2].values)
+
+    inter_peak_df = peak_df.iloc[peak_idx].reset_index(drop=True)
+    inter_reg_df = regdna_df.iloc[reg_idx].reset_index(drop=True)
+    ## Keep the overlapping part of peak
+    inter_peak_df.iloc[:, 1] = np.maximum(inter_peak_df.iloc[:, 1].values, inter_reg_df.iloc[:, 1].values)
+    inter_peak_df.iloc[:, 2] = np.minimum(inter_peak_df.iloc[:, 2].values, inter_reg_df.iloc[:, 2].values)
+    return pd.concat([inter_peak_df, inter_reg_df], axis=1, ignore_index=True)
+
+
+class RegDNAIndex:
+    """Interval index of regulatory DNA. Regions of each chromosome are sorted
+    by start and augmented with the running maximum of ends, so that the 
+    regions overlapping a peak are found by two binary searches, even when 
+    regions are long (e.g. enhancer windows) and overlap each other. Build 
+    once and query for every peak track.
+    """
+    def __init__(self, regdna_df, gene_df=None, genes=None):
+        """
+        Args:
+            regdna_df   - Regulatory DNA in dataframe of bed columns (chrom, 
+                        start, end, name, score, strand)
+            gene_df     - Gene annotation, for positions relative to genes
+            genes       - List of genes, for gene indices
+        """
+        chroms = regdna_df.iloc[:, 0].values.astype(str)
+        self.starts = regdna_df.iloc[:, 1].values.astype(np.int64)
+        self.ends = regdna_df.iloc[:, 2].values.astype(np.int64)
+        self.chrom_dict = {}
+        for chrom in np.unique(chroms):
+            idx = np.flatnonzero(chroms == chrom)
+            idx = idx[np.argsort(self.starts[idx], kind='stable')]
+            self.chrom_dict[chrom] = (
+                idx, self.starts[idx], self.ends[idx], np.maximum.accumulate(self.ends[idx]))
+
+        if gene_df is not None:
+            names = regdna_df.iloc[:, 3].values
+            self.strands = regdna_df.iloc[:, 5].values
+            gene_df = drop_duplicate_genes(gene_df).set_index('name').reindex(names)
+            self.gene_starts = gene_df['start'].values
+            self.gene_ends = gene_df['end'].values
+            self.gene_idx = map_gene_index(names, genes) if genes is not None else None
+
+    def find_overlaps(self, chroms, starts, ends):
+        """Find pairs of overlapping peaks and regions (half-open, 0-based).
+        Returns:
+            Tuple of peak and region (row) index arrays, ordered by peak then 
+            region
+        """
+        chroms = np.asarray(chroms).astype(str)
+        starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+
+        peak_idx_list, reg_idx_list = [], []
+        for chrom in np.unique(chroms):
+            if chrom not in self.chrom_dict:
+                continue
+            reg_idx, reg_starts, reg_ends, max_ends = self.chrom_dict[chrom]
+            peak_idx = np.flatnonzero(chroms == chrom)
+
+            ## Candidates start before peak end, and are after the last region
+            ## whose running maximum of ends does not reach peak start
+            lo = np.searchsorted(max_ends, starts[peak_idx], side='right')
+            hi = np.searchsorted(reg_starts, ends[peak_idx], side='left')
+            n_cands = np.maximum(hi - lo, 0)
+            pair_peak = np.repeat(peak_idx, n_cands)
+            pair_reg = np.arange(n_cands.sum()) - np.repeat(np.cumsum(n_cands) - n_cands, n_cands) + \
+                np.repeat(lo, n_cands)
+            is_overlap = reg_ends[pair_reg] > starts[pair_peak]
+            peak_idx_list.append(pair_peak[is_overlap])
+            reg_idx_list.append(reg_idx[pair_reg[is_overlap]])
+
+        if len(peak_idx_list) == 0:
+            return np.array([], dtype=int), np.array([], dtype=int)
+        peak_idx, reg_idx = np.concatenate(peak_idx_list), np.concatenate(reg_idx_list)
+        order = np.lexsort((reg_idx, peak_idx))
+        return peak_idx[order], reg_idx[order]
+
+    def query(self, chroms, starts, ends, scores):
+        """Assign peaks to the genes of overlapping regulatory regions. The
+        overlapping part of each peak is positioned relative to gene start (if
+        + strand) or gene stop (if - strand), as in intersect_peak_regdna. 
+        Regions without strand info are skipped.
+        Returns:
+            Tuple of arrays of gene index, relative start, relative end, and 
+            peak score
+        """
+        peak_idx, reg_idx = self.find_overlaps(chroms, starts, ends)
+        strands = self.strands[reg_idx]
+        is_plus, is_minus = strands == '+', strands == '-'
+        is_stranded = is_plus | is_minus
+        peak_idx, reg_idx, is_plus = peak_idx[is_stranded], reg_idx[is_stranded], is_plus[is_stranded]
+
+        peak_starts = np.maximum(np.asarray(starts)[peak_idx], self.starts[reg_idx])
+        peak_ends = np.minimum(np.asarray(ends)[peak_idx], self.ends[reg_idx])
+        gene_starts, gene_ends = self.gene_starts[reg_idx], self.gene_ends[reg_idx]
+        rel_starts = np.where(is_plus, peak_starts - gene_starts, gene_ends - peak_ends)
+        rel_ends = np.where(is_plus, peak_ends - gene_starts, gene_ends - peak_starts)
+        return self.gene_idx[reg_idx], rel_starts, rel_ends, np.asarray(scores)[peak_idx]
+
+
+def generate_peak_tracks(tracks, regdna_bed, gene_df, genes, feat_cols, 
+                        upstream_bound=None, n_workers=1, intersect_backend='bedtools'):
+    """Intersect peak tracks with regulatory DNA and index their genes, 
+    optionally in a pool of worker processes. Tracks are yielded as soon as 
+    they are done, so that a single process writes them into hdf5.
+    Args:
+        tracks          - List of tuples (feature type, feature name, bed filepath)
+        regdna_bed      - Regulatory DNA (region) in bed object
+        gene_df         - Gene annotation
+        genes           - List of genes
+        feat_cols       - Columns of output feature array
+        upstream_bound  - Upstream bound for matrix positions (None to keep 
+                        relative positions only)
+        n_workers       - Number of worker processes (all cores if 0)
+        intersect_backend   - Intersection by `bedtools` or `numpy`
+    Yields:
+        Tuple of feature type, feature name, feature array, and elapsed seconds
+    """
+    state = {
+        'regdna_fn': regdna_bed.fn, 'gene_df': gene_df, 'genes': genes, 
+        'feat_cols': feat_cols, 'upstream_bound': upstream_bound,
+        'intersect_backend': intersect_backend}
+    ## Regulatory DNA is indexed once and shared by all tracks
+    if intersect_backend == 'numpy':
+        state['regdna_index'] = RegDNAIndex(regdna_bed.to_dataframe(), gene_df, genes)
+    n_workers = n_workers if n_workers > 0 else mp.cpu_count()
+
+    if n_workers == 1:
+        ## Replace the state left by earlier calls in this process
+        PEAK_TRACK_STATE.clear()
+        PEAK_TRACK_STATE.update(state, regdna_bed=regdna_bed)
+        for track in tracks:
+            yield compute_peak_track(track)
+        return
+
+    ## Each worker keeps bedtools temporary files in its own directory
+    tmp_root = tempfile.mkdtemp(prefix='tfpr_bedtools_', dir=pybedtools.get_tempdir())
+    try:
+        with mp.Pool(
+                processes=min(n_workers, max(len(tracks), 1)), 
+                initializer=init_peak_track_worker, 
+                initargs=(state, tmp_root)) as pool:
+            for result in pool.imap_unordered(compute_peak_track, tracks):
+                yield result
+    finally:
+        shutil.rmtree(tmp_root, ignore_errors=True)
+
+
+def init_peak_track_worker(state, tmp_root):
+    pybedtools.set_tempdir(tempfile.mkdtemp(dir=tmp_root))
+    PEAK_TRACK_STATE.clear()
+    PEAK_TRACK_STATE.update(state, regdna_bed=BedTool(state['regdna_fn']))
+
+
+def compute_peak_track(track):
+    """Intersect a peak track with regulatory DNA, and convert it into feature
+    array of indexed genes.
+    """
+    feat_type, feat_name, filepath = track
+    start_time = time.time()
+    state = PEAK_TRACK_STATE
+    if state['intersect_backend'] == 'numpy':
+        peak_df = BedTool(filepath).to_dataframe()
+        gene_idx, rel_start, rel_end, peak_score = state['regdna_index'].query(
+            peak_df.iloc[:, 0].values, peak_df.iloc[:, 1].values, 
+            peak_df.iloc[:, 2].values, peak_df.iloc[:, 4].values)
+        feat_dict = {
+            'gene_idx': gene_idx, 'rel_start': rel_start, 
+            'rel_end': rel_end, 'peak_score': peak_score}
+        if state['upstream_bound'] is not None:
+            feat_dict['mtx_start'] = rel_start + state['upstream_bound']
+            feat_dict['mtx_end'] = rel_end + state['upstream_bound']
+        feat_arr = np.column_stack(
+            [np.asarray(feat_dict[x], dtype=float) for x in state['feat_cols']])
+        return feat_type, feat_name, feat_arr, time.time() - start_time
+
+    feat_df = intersect_peak_regdna(
+        BedTool(filepath), state['regdna_bed'], state['gene_df'], state['intersect_backend'])
+    if state['upstream_bound'] is not None:
+        feat_df = calculate_matrix_position(feat_df, state['upstream_bound'])
+    feat_df['gene_idx'] = map_gene_index(feat_df['gene'], state['genes'])
+    feat_arr = feat_df[state['feat_cols']].values.astype(float)
+    return feat_type, feat_name, feat_arr, time.time() - start_time
+
+
+def create_regdna(gene_bed, genome, reg_bound=(500, 500)):
     """Create regulatory region(s) for each gene.
     Args:
         gene_bed    - Gene annotation in bed object
         reg_bound   - Tuple for the boundary of regulatory region, i.e.
                         (upstream distance, downstream distance)
-        genome_fa   - Genome fasta filepath
+        genome      - IndexedGenome or genome fasta filepath
     Returns:
         Regulatory DNA (regions) in bed object
     """
     upstream_bound, downstream_bound = reg_bound
-    chrom_size_dict = {x.id: len(x) for x in load_fasta(genome_fa)}
+    if not isinstance(genome, IndexedGenome):
+        genome = IndexedGenome(genome)
     gene_df = gene_bed.to_dataframe()
     bed_cols = gene_df.columns
 
-    ## Calculate relative start and end, grouped by strand
-    regdna_df = pd.DataFrame(columns=bed_cols)
-    for chrom, subdf in gene_df.groupby('chrom'):
-        for strand, subdf2 in subdf.groupby('strand'):
-            if strand == '+':
-                subdf2['reg_start'] = subdf2['start'] - upstream_bound
-                subdf2['reg_end'] = subdf2['start'] + downstream_bound
-            elif strand == '-':
-                subdf2['reg_start'] = subdf2['end'] - downstream_bound
-                subdf2['reg_end'] = subdf2['end'] + upstream_bound  
-            else:
-                logger.warning('WARNING: {} does not have strand info. Skipped.'.format(
-                    np.unique(subdf2['gene'])))
-                continue
-
-            ## Reformat dataframe
-            subdf2 = subdf2.drop(columns=['start', 'end'])
-            subdf2 = subdf2.rename(columns={'reg_start': 'start', 'reg_end': 'end'})
-            subdf2.loc[subdf2['start'] < 1, 'start'] = 1
-            subdf2.loc[subdf2['end'] < 1, 'end'] = 1
-            subdf2.loc[
-                subdf2['start'] >= chrom_size_dict[chrom], 'start'] = \
-                chrom_size_dict[chrom] - 1
-            subdf2.loc[
-                subdf2['end'] >= chrom_size_dict[chrom], 'end'] = \
-                chrom_size_dict[chrom] - 1
-            regdna_df = regdna_df.append(subdf2, ignore_index=True)
+    strands = gene_df['strand'].values
+    is_plus, is_minus = strands == '+', strands == '-'
+    if not np.all(is_plus | is_minus):
+        logger.warning('WARNING: {} does not have strand info. Skipped.'.format(
+            np.unique(gene_df.loc[~(is_plus | is_minus), 'name'])))
+    regdna_df = gene_df.loc[is_plus | is_minus].copy()
+    is_plus = is_plus[is_plus | is_minus]
+
+    ## Calculate relative start and end by strand, and clip within chromosome
+    chroms, chrom_idx = np.unique(regdna_df['chrom'].values.astype(str), return_inverse=True)
+    chrom_sizes = np.array([genome.chrom_sizes[x] for x in chroms], dtype=int)[chrom_idx]
+    gene_start, gene_end = regdna_df['start'].values, regdna_df['end'].values
+    reg_start = np.where(is_plus, gene_start - upstream_bound, gene_end - downstream_bound)
+    reg_end = np.where(is_plus, gene_start + downstream_bound, gene_end + upstream_bound)
+    regdna_df['start'] = np.minimum(np.maximum(reg_start, 1), chrom_sizes - 1)
+    regdna_df['end'] = np.minimum(np.maximum(reg_end, 1), chrom_sizes - 1)
     return BedTool.from_dataframe(regdna_df[bed_cols]).sort()
 
 
@@ -113,124 +325,223 @@ def calculate_matrix_position(df, upstream_bound):
     return df
 
 
-def get_onehot_dna_sequence(regdna_bed, genome_fa, reg_bound, genes):
+def get_onehot_dna_sequence(regdna_bed, genome, reg_bound, genes):
     """Get DNA sequence from regulatory DNA bed object.
     """
     FEAT_COL = ['gene_idx', 'mtx_start', 'mtx_end', 'peak_score', 'alphabet']
     dna_df_list = []
 
     regdna_df = regdna_bed.to_dataframe()
-    regdna_fa = regdna_bed.getfasta(fi=genome_fa, name=True)
+    seqs = load_regdna_sequences(regdna_df, genome)
+    region_gene_idx = map_gene_index(regdna_df['name'], genes)
+    reg_len = reg_bound[0] + reg_bound[1]
 
-    for x in load_fasta(regdna_fa.seqfn):
+    for batch_start in range(0, len(seqs), DNA_BATCH_REGIONS):
+        batch = slice(batch_start, batch_start + DNA_BATCH_REGIONS)
+        batch_df = regdna_df.iloc[batch]
         ## Keep upstream at left
-        strand = regdna_df.loc[regdna_df['name'] == x.id, 'strand'].values[0]
-        seq = str(x.seq) if strand == '+' else str(x.seq)[::-1]
-        ## Convert one-hot encoding
-        dummy_seq = pd.get_dummies(list(seq))
-        shift = reg_bound[0] + reg_bound[1] - len(seq)
-        if shift > 0:  ## if regulatory region is shorter than queried region
-            blank_seq = pd.DataFrame(
-                data=np.zeros((shift, 4), dtype=int), 
-                columns=dummy_seq.columns)
-            dummy_seq = blank_seq.append(dummy_seq, ignore_index=False)
-
-        ## Convert to row and col index of the entries of ones
-        coord_idx, alphabet_idx = np.where(dummy_seq == 1)
-        gene_idx = genes.index(x.id)
-        tmp_df = pd.DataFrame({
-            'mtx_start': coord_idx,
-            'mtx_end': coord_idx + 1,
-            'alphabet': alphabet_idx})
-        tmp_df['gene_idx'] = gene_idx
-        tmp_df['peak_score'] = 1
-        dna_df_list.append(tmp_df)
+        alphabet_idx, region_idx, coord_idx = encode_dna_sequences(
+            seqs[batch], batch_df['strand'].values)
+        ## Pad at left if regulatory region is shorter than queried region
+        lengths = np.array([len(x) for x in seqs[batch]], dtype=int)
+        coord_idx = coord_idx + np.maximum(reg_len - lengths, 0)[region_idx]
+        gene_idx = region_gene_idx[batch]
+
+        ## Drop bases other than A, C, G, T (e.g. N)
+        is_base = alphabet_idx >= 0
+        dna_df_list.append(pd.DataFrame({
+            'gene_idx': gene_idx[region_idx[is_base]],
+            'mtx_start': coord_idx[is_base],
+            'mtx_end': coord_idx[is_base] + 1,
+            'peak_score': 1,
+            'alphabet': alphabet_idx[is_base].astype(int)}))
     return pd.concat(dna_df_list, ignore_index=True)[FEAT_COL]
 
 
-def get_onehot_dna_sequence_slim(regdna_bed, genome_fa, tss_df):
+def get_onehot_dna_sequence_slim(regdna_bed, genome, tss_df):
     """Get DNA sequence from regulatory DNA bed object.
     """
     FEAT_COL = ['gene_idx', 'rel_dist', 'alphabet']
     dna_df_list = []
 
     regdna_df = regdna_bed.to_dataframe()
-    regdna_fa = regdna_bed.getfasta(fi=genome_fa, name=True)
+    seqs = load_regdna_sequences(regdna_df, genome)
     genes = tss_df['name'].tolist()
-
-    print('==> get_onehot_dna_sequence_slim <==')
-    for i, s in enumerate(load_fasta(regdna_fa.seqfn)):
+    tss_pos_dict = drop_duplicate_genes(tss_df).set_index('name')['start'].to_dict()
+    region_gene_idx = map_gene_index(regdna_df['name'], genes)
+
+    logger.info('==> get_onehot_dna_sequence_slim <==')
+    for batch_start in range(0, len(seqs), DNA_BATCH_REGIONS):
+        batch = slice(batch_start, batch_start + DNA_BATCH_REGIONS)
+        batch_df = regdna_df.iloc[batch]
+        strands = batch_df['strand'].values
         ## Keep upstream at left
-        seq_info = regdna_df.iloc[i]
-        strand = seq_info['strand']
-        start_pos = seq_info['start']
-        end_pos = seq_info['end'] 
-        tss_pos = tss_df.loc[tss_df['name'] == s.id, 'start'].iloc[0]
-        
-        if strand == '+':
-            rel_dists = np.arange(start_pos, end_pos, dtype=int) - tss_pos
-            seq = str(s.seq)
-        else: 
-            rel_dists = tss_pos - np.arange(start_pos, end_pos, dtype=int)
-            seq = str(s.seq)[::-1]
-        ## Convert one-hot encoding
-        dummy_seq = pd.get_dummies(list(seq))
-
-        ## Convert to row and col index of the entries of ones
-        _, alphabet_idx = np.where(dummy_seq == 1)
-
-        if len(rel_dists) != len(alphabet_idx):
-            print(s.id)
-
-        gene_idx = genes.index(s.id)
-        tmp_df = pd.DataFrame({
-            'gene_idx': [gene_idx] * len(rel_dists),
-            'rel_dist': rel_dists,
-            'alphabet': alphabet_idx})
-        dna_df_list.append(tmp_df)
+        alphabet_idx, region_idx, coord_idx = encode_dna_sequences(seqs[batch], strands)
+
+        ## Genomic position of each base, and its distance to TSS
+        lengths = np.array([len(x) for x in seqs[batch]], dtype=int)
+        is_minus = (strands == '-')[region_idx]
+        start_pos = batch_df['start'].values.astype(int)[region_idx]
+        pos = np.where(
+            is_minus, start_pos + lengths[region_idx] - 1 - coord_idx, start_pos + coord_idx)
+        tss_pos = np.array([tss_pos_dict[x] for x in batch_df['name']], dtype=int)[region_idx]
+        rel_dists = np.where(is_minus, tss_pos - pos, pos - tss_pos)
+        gene_idx = region_gene_idx[batch]
+
+        ## Drop bases other than A, C, G, T (e.g. N)
+        is_base = alphabet_idx >= 0
+        dna_df_list.append(pd.DataFrame({
+            'gene_idx': gene_idx[region_idx[is_base]],
+            'rel_dist': rel_dists[is_base],
+            'alphabet': alphabet_idx[is_base].astype(int)}))
     return pd.concat(dna_df_list, ignore_index=True)[FEAT_COL]
 
 
-def get_nt_frequency(regdna_bed, genome_fa, genes):
-    """Get di-nucleotide frequences of regualtory DNA.
+def load_regdna_sequences(regdna_df, genome):
+    """Load the sequences of regulatory regions as byte strings, in the order
+    of regions in dataframe.
+    Args:
+        regdna_df   - Regulatory DNA (region) in dataframe of bed columns
+        genome      - IndexedGenome or genome fasta filepath
+    Returns:
+        List of sequences
+    """
+    if not isinstance(genome, IndexedGenome):
+        genome = IndexedGenome(genome)
+    return genome.fetch_regions(
+        regdna_df['chrom'].values, regdna_df['start'].values, regdna_df['end'].values)
+
+
+def encode_dna_sequences(seqs, strands):
+    """Encode DNA sequences into alphabet indices (A, C, G, T as 0-3, case 
+    insensitive, and -1 for other letters such as N) using a byte lookup 
+    table. Sequences on minus strand are reversed to keep upstream at left.
+    Args:
+        seqs        - List of sequences as byte strings
+        strands     - Array of strands of sequences
+    Returns:
+        Tuple of alphabet indices, sequence (region) indices, and positions 
+        in sequence (upstream at 0), concatenated over all sequences
+    """
+    lengths = np.array([len(x) for x in seqs], dtype=int)
+    buf = np.frombuffer(b''.join(seqs), dtype=np.uint8)
+    offsets = np.cumsum(lengths) - lengths
+    region_idx = np.repeat(np.arange(len(seqs)), lengths)
+    coord_idx = np.arange(len(buf)) - offsets[region_idx]
+    is_minus = (np.asarray(strands) == '-')[region_idx]
+    src_idx = np.where(
+        is_minus, offsets[region_idx] + lengths[region_idx] - 1 - coord_idx, 
+        np.arange(len(buf)))
+    return DNA_LOOKUP_TABLE[buf[src_idx]], region_idx, coord_idx
+
+
+def get_nt_frequency(regdna_bed, genome, genes, k=2, collapse_revcomp=True):
+    """Get k-mer (e.g. di-nucleotide) frequences of regualtory DNA. K-mers 
+    containing letters other than A, C, G, T are skipped, and counts are 
+    normalized by the total length of regulatory DNA of each gene.
+    Args:
+        regdna_bed          - Regulatory DNA (region) in bed object
+        genome              - IndexedGenome or genome fasta filepath
+        genes               - List of genes
+        k                   - Length of k-mers (1-6)
+        collapse_revcomp    - Boolean flag for combining each k-mer with its
+                            reverse complement (named after the smaller one)
+    Returns:
+        Dictionary of k-mer and its frequency array (in the order of genes)
     """
-    DINUCLEOTIDES = [
-        ['AA', 'TT'], ['AC', 'GT'], ['AG', 'CT'],
-        ['CA', 'TG'], ['CC', 'GG'], ['GA', 'TC'],
-        ['AT'], ['CG'], ['GC'], ['TA']]
-
-    ## Initialize freq dict for dints
-    nt_dict = {}
-    for dints in DINUCLEOTIDES:
-        for dint in dints:
-            nt_dict[dint] = np.zeros(len(genes))
-    len_dict = {i: 0 for i in range(len(genes))}
-
-    regdna_bed = regdna_bed.getfasta(fi=genome_fa, name=True)
-
-    for s in load_fasta(regdna_bed.seqfn):
-        gene_idx = genes.index(s.id)
-        seq_len = len(s.seq)
-        seq = str(s.seq)
-        
-        ## Add dint count and sequence length for each region 
-        for k in range(seq_len - 1):
-            dint = seq[k: k + 2]
-            if 'N' not in dint:
-                nt_dict[dint][gene_idx] += 1
-        len_dict[gene_idx] += seq_len
+    regdna_df = regdna_bed.to_dataframe()
+    seqs = load_regdna_sequences(regdna_df, genome)
+    gene_idx = map_gene_index(regdna_df['name'], genes)
+
+    ## Count k-mers and sequence length for each gene
+    counts = count_kmers(seqs, gene_idx, len(genes), k)
+    seq_lens = np.bincount(
+        gene_idx, weights=[len(x) for x in seqs], minlength=len(genes))
 
     ## Calcualte frequency
-    for dint in nt_dict.keys():
-        for gene_idx, seq_len in len_dict.items():
-            nt_dict[dint][gene_idx] /= seq_len
+    with np.errstate(divide='ignore', invalid='ignore'):
+        freqs = counts / seq_lens.reshape(-1, 1)
 
     ## Combine reverse complement
-    for dints in DINUCLEOTIDES:
-        if len(dints) > 1:
-            nt_dict[dints[0]] = nt_dict[dints[0]] + nt_dict[dints[1]]
-            del nt_dict[dints[1]]
-    return nt_dict
+    kmers = np.arange(4 ** k)
+    if collapse_revcomp:
+        rc_kmers = reverse_complement_kmers(kmers, k)
+        freqs = freqs + np.where(rc_kmers != kmers, 1, 0) * freqs[:, rc_kmers]
+        kmers = kmers[kmers <= rc_kmers]
+    return {decode_kmer(x, k): freqs[:, x] for x in kmers}
+
+
+def drop_duplicate_genes(gene_df):
+    """Keep the first annotation (e.g. TSS) of each gene, so that peaks and 
+    bases are positioned relative to a single gene start in all backends.
+    """
+    is_dup = gene_df['name'].duplicated().values
+    if is_dup.any():
+        logger.warning('WARNING: {} genes have multiple annotations. Used the first one.'.format(
+            len(np.unique(gene_df.loc[is_dup, 'name']))))
+    return gene_df.loc[~is_dup]
+
+
+def map_gene_index(names, genes):
+    """Map gene names to their indices in gene list. The first entry is used
+    for duplicated genes, as in list.index.
+    """
+    gene_idx_dict = {}
+    for i, g in enumerate(genes):
+        gene_idx_dict.setdefault(g, i)
+    return np.array([gene_idx_dict[x] for x in names], dtype=int)
+
+
+def count_kmers(seqs, gene_idx, n_genes, k):
+    """Count k-mers of sequences for each gene. Bases are encoded as 2-bit 
+    integers, and k-mers as rolling base-4 codes over each sequence.
+    Args:
+        seqs        - List of sequences as byte strings
+        gene_idx    - Array of gene index of each sequence
+        n_genes     - Number of genes
+        k           - Length of k-mers
+    Returns:
+        Count matrix (gene x k-mer code)
+    """
+    n_kmers = 4 ** k
+    counts = np.zeros((n_genes, n_kmers), dtype=np.int64)
+    for batch_start in range(0, len(seqs), DNA_BATCH_REGIONS):
+        batch = slice(batch_start, batch_start + DNA_BATCH_REGIONS)
+        codes, region_idx, coord_idx = encode_dna_sequences(
+            seqs[batch], np.full(len(seqs[batch]), '+'))
+        lengths = np.array([len(x) for x in seqs[batch]], dtype=int)
+
+        ## A k-mer starts at i if it is within the sequence and has no N
+        n_starts = len(codes) - k + 1
+        if n_starts <= 0:
+            continue
+        is_unknown = np.concatenate([[0], np.cumsum(codes < 0)])
+        is_valid = (is_unknown[k:] - is_unknown[:n_starts] == 0) & \
+            (coord_idx[:n_starts] <= lengths[region_idx[:n_starts]] - k)
+
+        kmer_codes = np.zeros(n_starts, dtype=np.int64)
+        for i in range(k):
+            kmer_codes = kmer_codes * 4 + codes[i:i + n_starts]
+        keys = gene_idx[batch][region_idx[:n_starts][is_valid]] * n_kmers + \
+            kmer_codes[is_valid]
+        keys, key_counts = np.unique(keys, return_counts=True)
+        counts.ravel()[keys] += key_counts
+    return counts
+
+
+def reverse_complement_kmers(kmers, k):
+    """Get the codes of reverse complement of k-mer codes.
+    """
+    rc_kmers = np.zeros_like(kmers)
+    for i in range(k):
+        rc_kmers = rc_kmers * 4 + (3 - (kmers // 4 ** i) % 4)
+    return rc_kmers
+
+
+def decode_kmer(kmer, k):
+    """Decode k-mer code into string.
+    """
+    return ''.join(DNA_ALPHABET[(kmer // 4 ** (k - 1 - i)) % 4] for i in range(k))
 
 
 def convert_gnashy_to_bed(filename, binarize_peak_score=False):
@@ -312,3 +623,204 @@ def liftover_bed(in_bed, chain_filename):
 
 def load_fasta(filepath):
     return SeqIO.parse(filepath, 'fasta')
+
+
+class IndexedGenome:
+    """Random access to genome sequence through a samtools-style fasta index
+    (.fai) and a memory-mapped fasta file, so that regions are sliced without
+    parsing the genome or writing temporary fasta files. The index is built 
+    (and saved next to the fasta if possible) when not found.
+    """
+    FAI_COLS = ['name', 'length', 'offset', 'line_bases', 'line_width']
+
+    def __init__(self, genome_fa):
+        self.filepath = genome_fa
+        fai_filepath = genome_fa + '.fai'
+        if os.path.exists(fai_filepath) and \
+                os.path.getmtime(fai_filepath) >= os.path.getmtime(genome_fa):
+            self.fai_df = pd.read_csv(
+                fai_filepath, sep='\t', header=None, usecols=range(5), 
+                names=self.FAI_COLS, dtype={'name': str})
+        else:
+            logger.info('Indexing genome {}'.format(genome_fa))
+            self.fai_df = build_fasta_index(genome_fa)
+            try:
+                self.fai_df.to_csv(fai_filepath, sep='\t', header=False, index=False)
+            except OSError:
+                logger.warning('Unable to save fasta index {}'.format(fai_filepath))
+        self.fai_dict = {x[0]: x[1:] for x in self.fai_df.itertuples(index=False)}
+        self.chrom_sizes = dict(zip(self.fai_df['name'], self.fai_df['length']))
+        self.fasta = np.memmap(genome_fa, dtype=np.uint8, mode='r')
+        ## Chromosomes requested but not in genome, warned once each
+        self.missing_chroms = set()
+
+    def fetch(self, chrom, start, end):
+        """Get the sequence of a region [start, end) in 0-based coordinates as
+        byte string. The region is clipped at the chromosome ends. Regions on
+        chromosomes missing from the genome (e.g. chrM or scaffolds) are 
+        skipped with a warning, as in `bedtools getfasta`.
+        """
+        if chrom not in self.fai_dict:
+            if chrom not in self.missing_chroms:
+                self.missing_chroms.add(chrom)
+                logger.warning('WARNING: {} is not in genome {}. Skipped.'.format(
+                    chrom, self.filepath))
+            return b''
+        length, offset, line_bases, line_width = self.fai_dict[chrom]
+        start, end = max(0, int(start)), min(length, int(end))
+        if start >= end:
+            return b''
+        byte_start = offset + (start // line_bases) * line_width + start % line_bases
+        byte_end = offset + ((end - 1) // line_bases) * line_width + (end - 1) % line_bases + 1
+        seq = self.fasta[byte_start:byte_end].tobytes()
+        if line_width > line_bases:  ## remove line breaks
+            seq = seq.replace(b'\n', b'').replace(b'\r', b'')
+        return seq
+
+    def fetch_regions(self, chroms, starts, ends):
+        """Get the sequences of regions as byte strings.
+        """
+        return [self.fetch(c, s, e) for c, s, e in zip(chroms, starts, ends)]
+
+
+def build_fasta_index(genome_fa):
+    """Build samtools-style fasta index of a genome, assuming that lines of 
+    each sequence have the same width (except the last line).
+    Args:
+        genome_fa   - Genome fasta filepath
+    Returns:
+        Dataframe of name, length, offset, line bases, and line width of
+        each sequence
+    """
+    rows = []
+    offset = 0
+    with open(genome_fa, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                rows.append([line[1:].split()[0].decode(), 0, offset + len(line), 0, 0])
+            elif len(rows) > 0:
+                line_bases = len(line.rstrip(b'\r\n'))
+                if rows[-1][3] == 0:
+                    rows[-1][3], rows[-1][4] = line_bases, len(line)
+                rows[-1][1] += line_bases
+            offset += len(line)
+    return pd.DataFrame(rows, columns=IndexedGenome.FAI_COLS)
+
+
+def check_feature_genes(f, genes):
+    """Check that the gene list of an existing hdf5 file is the same as the
+    current gene list, or write the gene list into a new hdf5 file. Return 
+    False if the gene lists are different.
+    """
+    if 'genes' not in f:
+        f.create_dataset('genes', data=np.array(genes, dtype='S'), compression='gzip')
+        return True
+    return [x.decode() for x in f['genes'][:]] == list(genes)
+
+
+def is_feature_current(f, group_name, unit, sources, params=None):
+    """Check if the datasets of a feature unit (the datasets computed together,
+    e.g. A, C, G, T channels of DNA sequence) exist in hdf5, and were computed
+    from unchanged source files with the same parameters.
+    Args:
+        f           - h5 file object
+        group_name  - Group of the datasets
+        unit        - Name of the feature unit
+        sources     - List of source filepaths
+        params      - Dictionary of parameters
+    Returns:
+        Boolean flag
+    """
+    dsets = get_feature_datasets(f, group_name, unit)
+    return len(dsets) > 0 and all([check_provenance(x.attrs, sources, params) for x in dsets])
+
+
+def get_feature_datasets(f, group_name, unit):
+    if group_name not in f:
+        return []
+    return [x for x in f[group_name].values() 
+            if isinstance(x, h5py.Dataset) and x.attrs.get('unit', None) == unit]
+
+
+def remove_feature_datasets(f, group_name, unit):
+    for x in get_feature_datasets(f, group_name, unit):
+        del f[x.name]
+
+
+def remove_stale_feature_datasets(f, units):
+    """Remove the datasets of feature units that are not in the current input,
+    and the groups left empty.
+    Args:
+        f           - h5 file object
+        units       - Set of tuples (group name, feature unit) in current input
+    Returns:
+        List of removed feature units
+    """
+    stale_units = set()
+    for group_name, g in list(f.items()):
+        if not isinstance(g, h5py.Group):
+            continue
+        for x in list(g.values()):
+            unit = x.attrs.get('unit', None)
+            if unit is not None and (group_name, unit) not in units:
+                stale_units.add(unit)
+                del f[x.name]
+        if len(g) == 0:
+            del f[group_name]
+    return sorted(stale_units)
+
+
+def write_feature_dataset(f, group_name, name, data, unit, sources, params=None, 
+                          record_md5=False):
+    """Write a feature dataset (replacing the existing one), and record its 
+    feature unit and provenance (path, size and mtime of source files, and 
+    parameters) as dataset attributes. The md5 checksums of source files are
+    recorded only if `record_md5` is set, i.e. for incremental updates.
+    """
+    g = f.require_group(group_name)
+    if name in g:
+        del g[name]
+    dset = g.create_dataset(name, data=data, compression='gzip')
+    dset.attrs['unit'] = unit
+    dset.attrs['source_path'] = np.array([os.path.abspath(x) for x in sources], dtype='S')
+    dset.attrs['source_size'] = np.array([os.path.getsize(x) for x in sources], dtype=np.int64)
+    dset.attrs['source_mtime'] = np.array([os.path.getmtime(x) for x in sources], dtype=float)
+    if record_md5:
+        dset.attrs['source_md5'] = np.array([calculate_md5(x) for x in sources], dtype='S')
+    dset.attrs['params'] = json.dumps(params or {}, sort_keys=True)
+    return dset
+
+
+def check_provenance(attrs, sources, params=None):
+    """Check if the recorded provenance matches the current source files and
+    parameters. A source file with different mtime but the same size is 
+    compared by md5 checksum, if recorded.
+    """
+    if 'source_path' not in attrs or \
+            attrs.get('params', None) != json.dumps(params or {}, sort_keys=True):
+        return False
+    paths = [os.path.abspath(x) for x in sources]
+    if [x.decode() for x in attrs['source_path']] != paths:
+        return False
+    for i, x in enumerate(paths):
+        if not os.path.exists(x) or os.path.getsize(x) != attrs['source_size'][i]:
+            return False
+        if os.path.getmtime(x) != attrs['source_mtime'][i] and ('source_md5' not in attrs or \
+                calculate_md5(x) != attrs['source_md5'][i].decode()):
+            return False
+    return True
+
+
+def calculate_md5(filepath, block_size=2 ** 24):
+    """Calculate md5 checksum of a file. Checksums are cached by file path, 
+    size and mtime.
+    """
+    st = os.stat(filepath)
+    key = (os.path.abspath(filepath), st.st_size, st.st_mtime)
+    if key not in SOURCE_MD5_CACHE:
+        h = hashlib.md5()
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                h.update(block)
+        SOURCE_MD5_CACHE[key] = h.hexdigest()
+    return SOURCE_MD5_CACHE[key]
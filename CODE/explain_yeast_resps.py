@@ -6,6 +6,7 @@ import warnings
 import logging.config
 
 from modeling_utils import *
+from feat_mtx_bundle import load_feat_mtx_bundle
 from response_explainer import TFPRExplainer
 
 
@@ -37,18 +38,56 @@ def parse_args(argv):
         '-f', '--feature_types', required=True, nargs='*',
         help='Feature type(s) to be included in feature matrix (delimited by single space).')
     parser.add_argument(
-        '-x', '--feature_h5', required=True,
+        '-x', '--feature_h5',
         help='h5 file for input features.')
     parser.add_argument(
-        '-y', '--response_label', required=True,
+        '-y', '--response_label',
         help='csv file for perturbation response label.')
     parser.add_argument(
         '-o', '--output_dir', required=True,
         help='Output directory path.')
+    parser.add_argument(
+        '--sparse', action='store_true',
+        help='Keep feature matrices sparse (features are scaled without centering).')
+    parser.add_argument(
+        '--shap_backend', default='interventional', 
+        choices=['interventional', 'xgb_native'],
+        help='SHAP backend: interventional TreeSHAP with background genes (default), or XGBoost native path-dependent contributions.')
+    parser.add_argument(
+        '--shap_csv', action='store_true',
+        help='Also export SHAP values in long format as gzipped csv (slow for large runs).')
+    parser.add_argument(
+        '--feat_mtx_format', default='h5', choices=['h5', 'csv'],
+        help='Output format of feature matrices: compressed HDF5 bundle (default), or gzipped csv.')
+    parser.add_argument(
+        '-b', '--input_bundle', 
+        help='HDF5 bundle of feature matrices and labels saved by a previous run, used instead of -x and -y.')
+    parser.add_argument(
+        '-c', '--cache_dir', 
+        help='Directory path for caching feature matrices across runs (disabled if not given).')
     parsed = parser.parse_args(argv[1:])
+    if parsed.input_bundle is None and (parsed.feature_h5 is None or parsed.response_label is None):
+        parser.error('-x/--feature_h5 and -y/--response_label are required without -b/--input_bundle')
     return parsed
 
 
+def create_feat_info_dict(tfs, feature_types, sparse=False):
+    """Create feature information dictionary from configuration.
+    """
+    return {
+        'tfs': tfs,
+        'feat_types': feature_types,
+        'sparse': sparse,
+        'feat_bins': PROMOTER_BINS,
+        'feat_length': PROMOTER_UPSTREAM_BOUND + PROMOTER_DOWNSTREAM_BOUND}
+
+
+def binarize_label_dict(label_df_dict):
+    """Binarize the labels of each TF by response cutoffs from configuration.
+    """
+    return {tf: binarize_label(ldf, MIN_RESP_LFC) for tf, ldf in label_df_dict.items()}
+
+
 def main(argv):
     ## Parse arguments
     args = parse_args(argv)
@@ -56,47 +95,43 @@ def main(argv):
     filepath_dict = {
         'feat_h5': args.feature_h5,
         'resp_label': args.response_label,
-        'output_dir': args.output_dir}
-    feat_info_dict = {
-        'tfs': args.tfs,
-        'feat_types': args.feature_types,
-        'feat_bins': PROMOTER_BINS,
-        'feat_length': PROMOTER_UPSTREAM_BOUND + PROMOTER_DOWNSTREAM_BOUND}
+        'output_dir': args.output_dir,
+        'feat_cache': args.cache_dir}
+    feat_info_dict = create_feat_info_dict(args.tfs, args.feature_types, args.sparse)
 
     ## Construct input feature matrix and labels
     logger.info('==> Constructing labels and feature matrix <==')
     
-    tf_feat_mtx_dict, nontf_feat_mtx, features, label_df_dict = \
-        construct_fixed_input(filepath_dict, feat_info_dict)
-    label_df_dict = {tf: binarize_label(ldf, MIN_RESP_LFC) for tf, ldf in label_df_dict.items()}
+    if args.input_bundle is not None:
+        try:
+            tf_feat_mtx_dict, nontf_feat_mtx, features, label_df_dict = \
+                load_feat_mtx_bundle(args.input_bundle, args.tfs, args.sparse)
+        except ValueError as e:
+            logger.error('{}. ==> Aborted <=='.format(e))
+            sys.exit(1)
+    else:
+        tf_feat_mtx_dict, nontf_feat_mtx, features, label_df_dict = \
+            construct_fixed_input(filepath_dict, feat_info_dict)
+        label_df_dict = binarize_label_dict(label_df_dict)
     
     logger.info('Per TF, label dim={}, TF-related feat dim={}, TF-unrelated feat dim={}'.format(
         label_df_dict[feat_info_dict['tfs'][0]].shape, 
         tf_feat_mtx_dict[feat_info_dict['tfs'][0]].shape,
         nontf_feat_mtx.shape))
 
-    # TODO: delete data pickling
-    # import pickle
-    # if not os.path.exists(filepath_dict['output_dir']):
-    #     os.makedirs(filepath_dict['output_dir'])
-    # with open(filepath_dict['output_dir'] + '/input_data.pkl', 'wb') as f: 
-    #     pickle.dump([tf_feat_mtx_dict, nontf_feat_mtx, features, label_df_dict], f)
-
-    # with open(filepath_dict['output_dir'] + '/input_data.pkl', 'rb') as f: 
-    #     tf_feat_mtx_dict, nontf_feat_mtx, features, label_df_dict = pickle.load(f)
-
     ## Model prediction and explanation
     tfpr_explainer = TFPRExplainer(tf_feat_mtx_dict, nontf_feat_mtx, features, label_df_dict)
     logger.info('==> Cross validating response prediction model <==')
     tfpr_explainer.cross_validate()
 
     logger.info('==> Analyzing feature contributions <==')
-    tfpr_explainer.explain()
+    tfpr_explainer.explain(shap_backend=args.shap_backend)
     
     logger.info('==> Saving output data <==')
     if not os.path.exists(filepath_dict['output_dir']):
         os.makedirs(filepath_dict['output_dir'])
-    tfpr_explainer.save(filepath_dict['output_dir'])
+    tfpr_explainer.save(filepath_dict['output_dir'], export_shap_csv=args.shap_csv, 
+        feat_mtx_format=args.feat_mtx_format)
     
     logger.info('==> Completed <==')
 
@@ -0,0 +1,149 @@
+import os
+import zlib
+import logging.config
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sps
+import h5py
+
+
+## Intialize logger
+logging.config.fileConfig('logging.ini', disable_existing_loggers=False)
+logger = logging.getLogger(__name__)
+
+## Target size of an uncompressed HDF5 chunk (4 MB) and deflate level
+CHUNK_BYTES = 4 * 1024 ** 2
+DEFLATE_LEVEL = 4
+
+
+def save_feat_mtx_bundle(filepath, tf_X, nontf_X, feats, tfs, genes, y, n_threads=None):
+    """Save the feature matrices, feature details, and labels of a run into one
+    compressed HDF5 bundle, which can be used as the input of a later run.
+    Args:
+        filepath    - h5 filepath
+        tf_X        - TF-related feature matrix ((TF, gene) x feature)
+        nontf_X     - TF-unrelated feature matrix (gene x feature)
+        feats       - List of feature details (feature type, name, start, end)
+        tfs         - List of TFs in the row order of tf_X
+        genes       - List of genes in the row order of nontf_X
+        y           - Labels in the row order of tf_X
+        n_threads   - Number of threads for compressing chunks (all cores if None)
+    """
+    n_threads = n_threads if n_threads is not None else os.cpu_count()
+    with h5py.File(filepath, 'w') as f:
+        write_feat_mtx(f, 'tf_X', tf_X, n_threads)
+        write_feat_mtx(f, 'nontf_X', nontf_X, n_threads)
+        f.create_dataset('feats', data=np.array(feats, dtype='S'))
+        f.create_dataset('tfs', data=np.array(tfs, dtype='S'))
+        f.create_dataset('genes', data=np.array(genes, dtype='S'))
+        f.create_dataset('tf_gene', data=np.array(
+            [tf + ':' + gene for tf in tfs for gene in genes], dtype='S'))
+        f.create_dataset('label', data=np.asarray(y))
+
+
+def load_feat_mtx_bundle(filepath, tfs=None, is_sparse=False):
+    """Load a bundle saved by save_feat_mtx_bundle as the input of a run, i.e.
+    in the format returned by construct_fixed_input/construct_expanded_input.
+    Args:
+        filepath    - h5 filepath
+        tfs         - List of TFs to be loaded (all TFs if None)
+        is_sparse   - Return csr (True) or dense (False) matrices
+    Returns:
+        Tuple of TF-related feature matrix dictionary, TF-unrelated feature
+        matrix, feature details, and label dictionary
+    """
+    with h5py.File(filepath, 'r') as f:
+        bundle_tfs = list(f['tfs'][:].astype(str))
+        genes = f['genes'][:].astype(str)
+        feats = [(x[0], x[1], int(x[2]), int(x[3])) for x in f['feats'][:].astype(str)]
+        tf_X = read_feat_mtx(f['tf_X'], is_sparse)
+        nontf_X = read_feat_mtx(f['nontf_X'], is_sparse)
+        y = f['label'][:]
+
+    tfs = tfs if tfs is not None else bundle_tfs
+    missing_tfs = sorted(set(tfs) - set(bundle_tfs))
+    if len(missing_tfs) > 0:
+        raise ValueError('TFs not found in bundle: {}'.format(', '.join(missing_tfs)))
+
+    n_genes = len(genes)
+    tf_feat_mtx_dict, label_dict = {}, {}
+    for tf in tfs:
+        i = bundle_tfs.index(tf)
+        tf_feat_mtx_dict[tf] = tf_X[i * n_genes:(i + 1) * n_genes]
+        label_dict[tf] = pd.Series(index=genes, data=y[i * n_genes:(i + 1) * n_genes])
+    return tf_feat_mtx_dict, nontf_X, feats, label_dict
+
+
+def write_feat_mtx(f, name, X, n_threads):
+    """Write a feature matrix into a group of the bundle, in csr format if that
+    is smaller than the dense matrix.
+    """
+    group = f.create_group(name)
+    group.attrs['shape'] = X.shape
+    if sps.issparse(X):
+        X = sps.csr_matrix(X)
+        dense_bytes = X.shape[0] * X.shape[1] * X.dtype.itemsize
+        sparse_bytes = X.data.nbytes + X.indices.nbytes + X.indptr.nbytes
+    else:
+        X = np.asarray(X)
+        dense_bytes = X.nbytes
+        nnz = np.count_nonzero(X)
+        sparse_bytes = nnz * (X.dtype.itemsize + 4) + (X.shape[0] + 1) * 8
+
+    if sparse_bytes < dense_bytes:
+        X = sps.csr_matrix(X)
+        group.attrs['format'] = 'csr'
+        for k in ['data', 'indices', 'indptr']:
+            write_chunked_dataset(group, k, getattr(X, k), n_threads)
+    else:
+        group.attrs['format'] = 'dense'
+        write_chunked_dataset(
+            group, 'data', X.toarray() if sps.issparse(X) else X, n_threads)
+
+
+def read_feat_mtx(group, is_sparse):
+    """Read a feature matrix from a group of the bundle.
+    """
+    shape = tuple(group.attrs['shape'])
+    if group.attrs['format'] == 'csr':
+        X = sps.csr_matrix(
+            (group['data'][:], group['indices'][:], group['indptr'][:]), shape=shape)
+        return X if is_sparse else X.toarray()
+    X = group['data'][:]
+    return sps.csr_matrix(X) if is_sparse else X
+
+
+def write_chunked_dataset(group, name, arr, n_threads):
+    """Write an array as a deflate-compressed dataset chunked along the first
+    axis. Chunks are compressed by a pool of threads (zlib releases the GIL),
+    and written in order as raw chunks, bypassing the HDF5 filter pipeline.
+    """
+    arr = np.ascontiguousarray(arr)
+    if arr.size == 0:
+        group.create_dataset(name, data=arr)
+        return
+    row_bytes = max(1, arr[:1].nbytes)
+    chunk_rows = int(min(arr.shape[0], max(1, CHUNK_BYTES // row_bytes)))
+    chunk_shape = (chunk_rows,) + arr.shape[1:]
+    dset = group.create_dataset(
+        name, shape=arr.shape, dtype=arr.dtype, chunks=chunk_shape,
+        compression='gzip', compression_opts=DEFLATE_LEVEL)
+
+    def compress_chunk(start):
+        block = arr[start:start + chunk_rows]
+        if block.shape[0] < chunk_rows:
+            ## Edge chunk is stored in full chunk shape
+            block = np.concatenate([
+                block, np.zeros((chunk_rows - block.shape[0],) + arr.shape[1:], dtype=arr.dtype)])
+        return zlib.compress(np.ascontiguousarray(block).tobytes(), DEFLATE_LEVEL)
+
+    starts = list(range(0, arr.shape[0], chunk_rows))
+    batch_size = 2 * max(1, n_threads)
+    with ThreadPoolExecutor(max_workers=max(1, n_threads)) as executor:
+        ## Submit in batches to bound the memory of compressed chunks in flight
+        for i in range(0, len(starts), batch_size):
+            batch = starts[i:i + batch_size]
+            for start, chunk in zip(batch, executor.map(compress_chunk, batch)):
+                dset.id.write_direct_chunk((start,) + (0,) * (arr.ndim - 1), chunk)
@@ -0,0 +1,144 @@
+import os
+import glob
+import hashlib
+import configparser
+import logging.config
+import numpy as np
+import scipy.sparse as sps
+import h5py
+
+
+## Intialize logger
+logging.config.fileConfig('logging.ini', disable_existing_loggers=False)
+logger = logging.getLogger(__name__)
+
+## Load default configuration
+config = configparser.ConfigParser()
+config.read('config.ini')
+FEAT_CACHE_MAX_GB = float(config['DEFAULT']['feat_cache_max_gb'])
+
+## Feature construction parameters that change the content of feature matrix
+CACHE_KEY_PARAMS = [
+    'feat_length', 'feat_bins', 'promo_bound', 'promo_width',
+    'enhan_bound', 'enhan_min_width']
+
+
+def create_feat_cache_key(h5_filepath, feat_tuple, gene_map, is_fixed_input, **kwargs):
+    """Create cache key of a feature matrix. The key is a hash of the h5 dataset
+    (its provenance recorded by preprocessing, or its content if none), the
+    gene index mapping (common genes), and the binning parameters.
+    Args:
+        h5_filepath     - h5 filepath
+        feat_tuple      - Tuple (feature type, feature name)
+        gene_map        - Index mapping array of h5 genes to common genes
+        is_fixed_input  - Boolean flag for fixed (True) or expanded (False) input
+        kwargs          - Feature construction parameters
+    Returns:
+        Hex digest string
+    """
+    feat_type, feat_name = feat_tuple
+    h = hashlib.sha1()
+    h.update('{}/{}|fixed={}'.format(feat_type, feat_name, is_fixed_input).encode())
+
+    ## Hash h5 dataset by provenance, which avoids reading the whole track
+    with h5py.File(h5_filepath, 'r') as f:
+        dset = f['{}/{}'.format(feat_type, feat_name)]
+        h.update(str((dset.dtype.str, dset.shape)).encode())
+        if 'source_path' in dset.attrs:
+            h.update(hash_provenance(dset.attrs).encode())
+            h.update(np.ascontiguousarray(f['genes'][:]).tobytes())
+        else:
+            h.update(np.ascontiguousarray(dset[:]).tobytes())
+
+    ## Hash gene index mapping
+    h.update(hash_gene_map(gene_map).encode())
+
+    ## Hash binning parameters
+    params = [(k, kwargs.get(k, None)) for k in CACHE_KEY_PARAMS]
+    h.update(repr(params).encode())
+    return h.hexdigest()
+
+
+def hash_provenance(attrs):
+    """Hash the provenance attributes of a h5 dataset, i.e. the feature unit,
+    the path, size, mtime (and md5 if recorded) of source files, and the 
+    parameters.
+    """
+    items = [(k, np.asarray(attrs[k]).tolist()) for k in sorted(attrs.keys())]
+    return hashlib.sha1(repr(items).encode()).hexdigest()
+
+
+def hash_gene_map(gene_map):
+    """Hash the index mapping (array) of h5 genes to common genes, as sorted 
+    (h5 index, common index) pairs.
+    """
+    gene_map = np.asarray(gene_map, dtype=np.int64)
+    h_idx = np.flatnonzero(gene_map >= 0)
+    items = np.column_stack([h_idx, gene_map[h_idx]]).astype(np.int64)
+    return hashlib.sha1(items.tobytes()).hexdigest()
+
+
+def get_feat_cache_filepath(cache_dir, feat_tuple, key):
+    return '{}/{}__{}__{}.npz'.format(cache_dir, feat_tuple[0], feat_tuple[1], key)
+
+
+def load_cached_feat_mtx(cache_dir, feat_tuple, key):
+    """Load cached feature matrix. Return None if not cached.
+    """
+    filepath = get_feat_cache_filepath(cache_dir, feat_tuple, key)
+    if not os.path.exists(filepath):
+        return None
+    try:
+        mtx = sps.load_npz(filepath).tocsc()
+    except (OSError, ValueError) as e:
+        logger.warning('Failed to load cached feature {} > {}: {}'.format(
+            feat_tuple[0], feat_tuple[1], e))
+        return None
+    ## Mark as recently used for eviction, unless evicted by a concurrent job
+    try:
+        os.utime(filepath, None)
+    except OSError:
+        pass
+    return mtx
+
+
+def save_cached_feat_mtx(cache_dir, feat_tuple, key, mtx):
+    """Save feature matrix into cache. Write to a temporary file first so that
+    concurrent jobs never read a partially written matrix.
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    filepath = get_feat_cache_filepath(cache_dir, feat_tuple, key)
+    tmp_filepath = '{}.{}.tmp.npz'.format(filepath[:-4], os.getpid())
+    sps.save_npz(tmp_filepath, sps.csc_matrix(mtx), compressed=False)
+    os.replace(tmp_filepath, filepath)
+
+
+def evict_feat_cache(cache_dir, max_gb=FEAT_CACHE_MAX_GB):
+    """Evict least recently used feature matrices and label stores until the
+    total size of the cache is below the limit.
+    """
+    if not os.path.exists(cache_dir):
+        return
+    filepaths = [x for x in glob.glob('{}/*.npz'.format(cache_dir))
+                if not x.endswith('.tmp.npz')]
+    filepaths += glob.glob('{}/labels__*.h5'.format(cache_dir))
+    stats = []
+    for x in filepaths:
+        try:
+            st = os.stat(x)
+        except OSError:  ## removed by a concurrent job
+            continue
+        stats.append((st.st_mtime, st.st_size, x))
+
+    max_bytes = max_gb * 1024 ** 3
+    total_bytes = sum([x[1] for x in stats])
+    for _, size, x in sorted(stats):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(x)
+            total_bytes -= size
+            logger.info('Evicted cached file {}'.format(os.path.basename(x)))
+        except OSError:
+            continue
@@ -0,0 +1,172 @@
+import os
+import hashlib
+import logging.config
+import numpy as np
+import pandas as pd
+import h5py
+
+
+## Intialize logger
+logging.config.fileConfig('logging.ini', disable_existing_loggers=False)
+logger = logging.getLogger(__name__)
+
+## Label stores opened in this process, keyed by label file and format
+LABEL_STORES = {}
+
+
+def load_label_store(filepath, is_long_csv=False, tf_col=None, gene_col=None, store_dir=None):
+    """Get the label store of a label csv, which is parsed only once per process.
+    Args:
+        filepath        - Filepath of label csv matrix
+        is_long_csv     - csv file in long (True) or wide (False) format
+        tf_col          - Column name for TFs
+        gene_col        - Column name for genes
+        store_dir       - Directory to persist the store across runs (in
+                        memory only if None)
+    Returns:
+        LabelStore object
+    """
+    key = (os.path.abspath(filepath), is_long_csv, tf_col, gene_col, store_dir)
+    if key not in LABEL_STORES:
+        LABEL_STORES[key] = LabelStore(filepath, is_long_csv, tf_col, gene_col, store_dir)
+    return LABEL_STORES[key]
+
+
+class LabelStore:
+    """Response labels of a wide or long csv, indexed by TF. The csv is parsed
+    once, and the labels of each TF are kept as gene indices and values. If a
+    store directory is given, labels are saved in HDF5 with one group per TF,
+    so later runs read only the groups of requested TFs instead of the csv.
+    """
+    def __init__(self, filepath, is_long_csv=False, tf_col=None, gene_col=None, store_dir=None):
+        """
+        Args:
+            filepath        - Filepath of label csv matrix
+            is_long_csv     - csv file in long (True) or wide (False) format
+            tf_col          - Column name for TFs
+            gene_col        - Column name for genes
+            store_dir       - Directory to persist the store (None for in memory)
+        """
+        self.filepath = filepath
+        self.is_long_csv = is_long_csv
+        self.tf_col = tf_col
+        self.gene_col = gene_col
+        self.store_filepath = None
+        self.tf_data = {}
+
+        if store_dir is not None:
+            self.store_filepath = '{}/labels__{}__{}.h5'.format(
+                store_dir, os.path.basename(filepath), self.create_store_key())
+            if os.path.exists(self.store_filepath):
+                self.load_index()
+                ## Mark as recently used for eviction with the feature cache
+                os.utime(self.store_filepath, None)
+                return
+        self.parse_csv()
+        if self.store_filepath is not None:
+            self.save(store_dir)
+
+    def create_store_key(self):
+        """Hash the label file (path, size, mtime) and its format.
+        """
+        st = os.stat(self.filepath)
+        h = hashlib.sha1()
+        h.update(repr((
+            os.path.abspath(self.filepath), st.st_size, st.st_mtime_ns,
+            self.is_long_csv, self.tf_col, self.gene_col)).encode())
+        return h.hexdigest()
+
+    def parse_csv(self):
+        """Parse the label csv into per-TF gene indices and values.
+        """
+        logger.info('Parsing label file {}'.format(self.filepath))
+        if self.is_long_csv:
+            header = pd.read_csv(self.filepath, nrows=0).columns
+            self.value_cols = ['log2FoldChange']
+            if 'padj' in header:
+                self.value_cols.append('padj')
+            df = pd.read_csv(
+                self.filepath, usecols=[self.tf_col, self.gene_col] + self.value_cols)
+            self.index_name = self.gene_col
+            self.genes = np.array(sorted(df[self.gene_col].unique()))
+            gene_idx = np.searchsorted(self.genes, df[self.gene_col].values)
+            ## Group rows by TF with one stable sort, keeping the csv row order
+            order = np.argsort(df[self.tf_col].values, kind='stable')
+            tfs, tf_starts = np.unique(df[self.tf_col].values[order], return_index=True)
+            self.tfs = tfs.tolist()
+            tf_stops = np.append(tf_starts[1:], len(order))
+            for tf, start, stop in zip(self.tfs, tf_starts, tf_stops):
+                rows = order[start:stop]
+                self.tf_data[tf] = (gene_idx[rows], {
+                    col: df[col].values[rows] for col in self.value_cols})
+        else:
+            df = pd.read_csv(self.filepath, index_col=0)
+            self.value_cols = None
+            self.index_name = df.index.name
+            self.genes = df.index.values
+            self.tfs = df.columns.tolist()
+            gene_idx = np.arange(len(self.genes))
+            for tf in self.tfs:
+                self.tf_data[tf] = (gene_idx, {'value': df[tf].values})
+
+    def save(self, store_dir):
+        """Save the store in HDF5. Write to a temporary file first so that
+        concurrent jobs never read a partially written store.
+        """
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir, exist_ok=True)
+        tmp_filepath = '{}.{}.tmp'.format(self.store_filepath, os.getpid())
+        with h5py.File(tmp_filepath, 'w') as f:
+            f.attrs['is_long_csv'] = self.is_long_csv
+            f.attrs['index_name'] = self.index_name if self.index_name is not None else ''
+            f.create_dataset('genes', data=np.array(self.genes, dtype='S'))
+            f.create_dataset('tfs', data=np.array(self.tfs, dtype='S'))
+            for i, tf in enumerate(self.tfs):
+                ## Groups are named by TF order, as TF names may contain '/'
+                group = f.create_group('labels/{}'.format(i))
+                gene_idx, val_dict = self.tf_data[tf]
+                group.create_dataset('gene_idx', data=gene_idx.astype(np.int32))
+                for col, vals in val_dict.items():
+                    group.create_dataset(col, data=vals)
+        os.replace(tmp_filepath, self.store_filepath)
+
+    def load_index(self):
+        """Load genes and TFs of a saved store. Labels are read per TF on request.
+        """
+        with h5py.File(self.store_filepath, 'r') as f:
+            self.is_long_csv = bool(f.attrs['is_long_csv'])
+            self.index_name = f.attrs['index_name'] or None
+            self.genes = f['genes'][:].astype(str)
+            self.tfs = f['tfs'][:].astype(str).tolist()
+        self.value_cols = ['log2FoldChange', 'padj'] if self.is_long_csv else None
+
+    def load_tf_data(self, tf):
+        """Get the gene indices and values of a TF, reading from HDF5 if needed.
+        """
+        if tf not in self.tf_data:
+            try:
+                with h5py.File(self.store_filepath, 'r') as f:
+                    group = f['labels/{}'.format(self.tfs.index(tf))]
+                    gene_idx = group['gene_idx'][:]
+                    self.tf_data[tf] = (gene_idx, {
+                        col: group[col][:] for col in group.keys() if col != 'gene_idx'})
+            except OSError:  ## evicted from cache by a concurrent job
+                self.parse_csv()
+        return self.tf_data[tf]
+
+    def get_label(self, tf, genes=None):
+        """Get the labels of a TF, in the format of create_model_label.
+        Args:
+            tf      - Transcription factor
+            genes   - Gene list, by which the label is ordered
+        Returns:
+            Label series (wide) or dataframe of log2FoldChange and padj (long)
+        """
+        gene_idx, val_dict = self.load_tf_data(tf)
+        index = pd.Index(self.genes[gene_idx], name=self.index_name)
+        if self.is_long_csv:
+            cols = [x for x in self.value_cols if x in val_dict]
+            label_df = pd.DataFrame({col: val_dict[col] for col in cols}, index=index, columns=cols)
+        else:
+            label_df = pd.Series(val_dict['value'], index=index, name=tf)
+        return label_df.reindex(genes) if genes is not None else label_df
@@ -1,4 +1,7 @@
 import sys
+import os
+import shutil
+import tempfile
 import numpy as np
 import pandas as pd
 import configparser
@@ -9,6 +12,10 @@ import multiprocess as mp
 from sklearn.preprocessing import StandardScaler, MinMaxScaler
 from pybedtools import BedTool
 
+from feat_mtx_cache import create_feat_cache_key, load_cached_feat_mtx, \
+    save_cached_feat_mtx, evict_feat_cache
+from label_store import load_label_store
+
 
 ## Intialize logger
 logging.config.fileConfig('logging.ini', disable_existing_loggers=False)
@@ -18,6 +25,13 @@ logger = logging.getLogger(__name__)
 config = configparser.ConfigParser()
 config.read('config.ini')
 RAND_NUM = int(config['DEFAULT']['rand_num'])
+TMP_PATH = config['DEFAULT']['tmp_path'].strip('\'"')
+FEAT_MTX_WORKERS = int(config['DEFAULT']['feat_mtx_workers'])
+FEAT_MTX_MEM_GB = float(config['DEFAULT']['feat_mtx_mem_gb'])
+
+## Estimated peak memory of building a feature matrix, as a multiple of the 
+## size of its h5 dataset
+FEAT_MTX_MEM_FACTOR = 10
 
 
 def construct_expanded_input(filepath_dict, feat_info_dict):
@@ -28,74 +42,40 @@ def construct_expanded_input(filepath_dict, feat_info_dict):
         feat_info_dict  - Feature information dictionary for feature types,
                         quantized length, and quantized bins
     Returns:
-        A tuple of feature matrix (in numpy.ndarray), corresponding features, 
+        A tuple of feature matrix (in numpy.ndarray, or scipy csr matrix if 
+        `sparse` is set in feat_info_dict), corresponding features, 
         and label dataframe
     """
     ## Get common genes between feature matrix and label matrix
     tfs = feat_info_dict['tfs']
+    is_sparse = feat_info_dict.get('sparse', False)
     h5_filepath = filepath_dict['feat_h5']
     label_filepath = filepath_dict['resp_label']
     genes, gene_map, _ = create_gene_index_map(
-        h5_filepath, label_filepath, True, 'gene_ensg')
+        h5_filepath, label_filepath, True, 'gene_ensg', 'tf_ensg',
+        store_dir=filepath_dict.get('feat_cache', None))
 
     ## Create model label and feature matrix
     labels_dict = {tf: create_model_label(
-        label_filepath, tf, genes, True, 'tf_ensg', 'gene_ensg') for tf in tfs}
+        label_filepath, tf, genes, True, 'tf_ensg', 'gene_ensg',
+        store_dir=filepath_dict.get('feat_cache', None)) for tf in tfs}
 
     ## Create feature name lists for tf related and tf unrelated feature types and names
     tf_features, nontf_features = get_h5_features(
         h5_filepath, feat_info_dict['feat_types'], tfs)
     tf_feat_types = sorted(set([x[0] for x in tf_features]))
 
-    ## Create feature matrix for each feautre in parallel
-    tf_mp_dict = create_feat_mtx_parallel(
-        tf_features, h5_filepath, gene_map,
-        is_fixed_input=False,
-        promo_bound=feat_info_dict['promo_bound'],
-        enhan_bound=feat_info_dict['enhan_bound'],
-        promo_width=feat_info_dict['promo_width'],
-        enhan_min_width=feat_info_dict['enhan_min_width'])
-
-    nontf_mp_dict = create_feat_mtx_parallel(
-        nontf_features, h5_filepath, gene_map,
+    ## Create feature matrix for each feautre in parallel, assembled by column layout
+    tf_feat_mtx_dict, nontf_feat_mtx, feat_details = assemble_feat_mtx(
+        tfs, tf_features, nontf_features, h5_filepath, gene_map, len(genes),
         is_fixed_input=False,
+        is_sparse=is_sparse,
+        cache_dir=filepath_dict.get('feat_cache', None),
         promo_bound=feat_info_dict['promo_bound'],
         enhan_bound=feat_info_dict['enhan_bound'],
         promo_width=feat_info_dict['promo_width'],
         enhan_min_width=feat_info_dict['enhan_min_width'])
 
-    ## Concatenate feature matrices in order
-    col_idx = 0
-    tf_feat_mtx_dict = {}
-    feat_details = []
-
-    for i, tf in enumerate(tfs):
-        tf_feat_mtx = sps.csc_matrix((len(gene_map), 0))
-
-        for feat_type in tf_feat_types:
-            mtx = tf_mp_dict[(feat_type, tf)]
-            mtx_bins = mtx.shape[1]
-            tf_feat_mtx = sps.hstack((tf_feat_mtx, mtx))
-
-            if i == 0:  ## Only increment for the first TF
-                feat_details.append((feat_type, 'TF') + (col_idx, col_idx + mtx_bins))
-                col_idx += mtx_bins
-
-        tf_feat_mtx_dict[tf] = tf_feat_mtx.toarray()
-
-    ## Concatenate feature matrices in order for tf unrelated features 
-    nontf_feat_mtx = sps.csc_matrix((len(gene_map), 0))
-
-    for feat_tuple in nontf_features:
-        mtx = nontf_mp_dict[feat_tuple]
-        mtx_bins = mtx.shape[1]
-        nontf_feat_mtx = sps.hstack((nontf_feat_mtx, mtx))
-
-        feat_details.append(feat_tuple + (col_idx, col_idx + mtx_bins))
-        col_idx += mtx_bins
-    
-    nontf_feat_mtx = nontf_feat_mtx.toarray()
-
     return tf_feat_mtx_dict, nontf_feat_mtx, feat_details, labels_dict
 
 
@@ -108,95 +88,301 @@ def construct_fixed_input(filepath_dict, feat_info_dict):
         feat_info_dict  - Feature information dictionary for feature types,
                         quantized length, and quantized bins
     Returns:
-        A tuple of feature matrix (in numpy.ndarray), corresponding features, 
+        A tuple of feature matrix (in numpy.ndarray, or scipy csr matrix if 
+        `sparse` is set in feat_info_dict), corresponding features, 
         and label dataframe
     """
     ## Get common genes between feature matrix and label matrix
     tfs = feat_info_dict['tfs']
+    is_sparse = feat_info_dict.get('sparse', False)
     h5_filepath = filepath_dict['feat_h5']
     label_filepath = filepath_dict['resp_label']
-    genes, gene_map, _ = create_gene_index_map(h5_filepath, label_filepath)
+    genes, gene_map, _ = create_gene_index_map(
+        h5_filepath, label_filepath, store_dir=filepath_dict.get('feat_cache', None))
 
     ## Create model label in dict
-    labels_dict = {tf: create_model_label(label_filepath, tf, genes) for tf in tfs}
+    labels_dict = {tf: create_model_label(
+        label_filepath, tf, genes, 
+        store_dir=filepath_dict.get('feat_cache', None)) for tf in tfs}
 
     ## Create feature name lists for tf related and tf unrelated feature types and names
     tf_features, nontf_features = get_h5_features(
         h5_filepath, feat_info_dict['feat_types'], tfs)
     tf_feat_types = sorted(set([x[0] for x in tf_features]))
 
-    ## Create feature matrix for each feautre in parallel
-    tf_mp_dict = create_feat_mtx_parallel(
-        tf_features, h5_filepath, gene_map, 
+    ## Create feature matrix for each feautre in parallel, assembled by column layout
+    tf_feat_mtx_dict, nontf_feat_mtx, feat_details = assemble_feat_mtx(
+        tfs, tf_features, nontf_features, h5_filepath, gene_map, len(genes),
+        is_fixed_input=True,
+        is_sparse=is_sparse,
+        cache_dir=filepath_dict.get('feat_cache', None),
         feat_length=feat_info_dict['feat_length'], 
         feat_bins=feat_info_dict['feat_bins'])
 
-    nontf_mp_dict = create_feat_mtx_parallel(
-        nontf_features, h5_filepath, gene_map, 
-        feat_length=feat_info_dict['feat_length'], 
-        feat_bins=feat_info_dict['feat_bins'])
-
-    ## Concatenate feature matrices in order for tf related features
-    col_idx = 0
-    tf_feat_mtx_dict = {}
-    feat_details = []
-
-    for i, tf in enumerate(tfs):
-        tf_feat_mtx = sps.csc_matrix((len(gene_map), 0))
+    return tf_feat_mtx_dict, nontf_feat_mtx, feat_details, labels_dict
 
-        for feat_type in tf_feat_types:
-            mtx = tf_mp_dict[(feat_type, tf)]
-            mtx_bins = mtx.shape[1]
-            tf_feat_mtx = sps.hstack((tf_feat_mtx, mtx))
 
-            if i == 0:  ## Only increment for the first TF
-                feat_details.append((feat_type, 'TF') + (col_idx, col_idx + mtx_bins))
-                col_idx += mtx_bins
+def construct_shared_input(filepath_dict, feat_info_dict, is_fixed_input=True):
+    """Construct the inputs shared by runs of a sweep over groups of TFs, i.e.
+    common genes and gene index map, labels of all TFs, and TF-unrelated feature
+    matrices, so that each group only builds its TF-related features.
+    Args:
+        filepath_dict   - Filepath dictionary for h5 features and response labels
+        feat_info_dict  - Feature information dictionary, where `tfs` are the
+                        TFs of all groups
+        is_fixed_input  - Boolean flag for fixed (yeast) or expanded (human) input
+    Returns:
+        Dictionary of genes, gene map, label dictionary, and dictionary of 
+        TF-unrelated feature matrices (csc)
+    """
+    h5_filepath = filepath_dict['feat_h5']
+    label_filepath = filepath_dict['resp_label']
+    store_dir = filepath_dict.get('feat_cache', None)
+    label_kwargs = {} if is_fixed_input else {
+        'is_long_csv': True, 'tf_col': 'tf_ensg', 'gene_col': 'gene_ensg'}
+    genes, gene_map, _ = create_gene_index_map(
+        h5_filepath, label_filepath, store_dir=store_dir, **label_kwargs)
+    labels_dict = {tf: create_model_label(
+        label_filepath, tf, genes, store_dir=store_dir, **label_kwargs) 
+        for tf in feat_info_dict['tfs']}
 
-        tf_feat_mtx_dict[tf] = tf_feat_mtx.toarray()
+    ## TF-unrelated features of any group, depending on which TFs have expression
+    nontf_features = set()
+    for tf in feat_info_dict['tfs']:
+        nontf_features |= set(get_h5_features(h5_filepath, feat_info_dict['feat_types'], [tf])[1])
+    nontf_mtx_dict = create_feat_mtx_parallel(
+        sorted(nontf_features), h5_filepath, gene_map, is_fixed_input, store_dir,
+        **get_feat_kwargs(feat_info_dict, is_fixed_input))
+    return {
+        'genes': genes, 'gene_map': gene_map, 'labels_dict': labels_dict, 
+        'nontf_mtx_dict': nontf_mtx_dict}
+
+
+def construct_group_input(filepath_dict, feat_info_dict, shared_dict, is_fixed_input=True,
+                        n_workers=FEAT_MTX_WORKERS, mem_gb=FEAT_MTX_MEM_GB):
+    """Construct the input of a TF group from the shared input of a sweep, in the
+    format returned by construct_fixed_input/construct_expanded_input. Groups 
+    running concurrently should split the number of feature workers (n_workers)
+    and the memory budget (mem_gb) among them.
+    """
+    tfs = feat_info_dict['tfs']
+    is_sparse = feat_info_dict.get('sparse', False)
+    genes = shared_dict['genes']
+    tf_features, nontf_features = get_h5_features(
+        filepath_dict['feat_h5'], feat_info_dict['feat_types'], tfs)
+    feat_kwargs = get_feat_kwargs(feat_info_dict, is_fixed_input)
+
+    ## Build TF-related features only, and lay out shared TF-unrelated features
+    tf_feat_mtx_dict, _, _ = assemble_feat_mtx(
+        tfs, tf_features, [], filepath_dict['feat_h5'], shared_dict['gene_map'], len(genes),
+        is_fixed_input, is_sparse, filepath_dict.get('feat_cache', None), 
+        n_workers=n_workers, mem_gb=mem_gb, **feat_kwargs)
+    feat_details = plan_feat_layout(
+        sorted(set([x[0] for x in tf_features])), nontf_features, is_fixed_input, **feat_kwargs)[0]
+    nontf_feat_mtx = convert_feat_mtx_format(concat_csc_mtx(
+        [shared_dict['nontf_mtx_dict'][x] for x in nontf_features], len(genes)), is_sparse)
+    labels_dict = {tf: shared_dict['labels_dict'][tf] for tf in tfs}
+    return tf_feat_mtx_dict, nontf_feat_mtx, feat_details, labels_dict
 
-    ## Concatenate feature matrices in order for tf unrelated features 
-    nontf_feat_mtx = sps.csc_matrix((len(gene_map), 0))
 
-    for feat_tuple in nontf_features:
-        mtx = nontf_mp_dict[feat_tuple]
-        mtx_bins = mtx.shape[1]
-        nontf_feat_mtx = sps.hstack((nontf_feat_mtx, mtx))
+def get_feat_kwargs(feat_info_dict, is_fixed_input=True):
+    """Get feature construction parameters from feature information dictionary.
+    """
+    keys = ['feat_length', 'feat_bins'] if is_fixed_input else [
+        'promo_bound', 'enhan_bound', 'promo_width', 'enhan_min_width']
+    return {k: feat_info_dict[k] for k in keys}
 
-        feat_details.append(feat_tuple + (col_idx, col_idx + mtx_bins))
-        col_idx += mtx_bins
 
-    nontf_feat_mtx = nontf_feat_mtx.toarray()
+def plan_feat_layout(tf_feat_types, nontf_features, is_fixed_input=True, **kwargs):
+    """Compute the column ranges of all features before building them. TF-related
+    feature types are laid out in the TF-related block, followed by TF-unrelated
+    features in the TF-unrelated block.
+    Args:
+        tf_feat_types   - Sorted list of TF-related feature types
+        nontf_features  - List of TF-unrelated features (feature type, name)
+        is_fixed_input  - Boolean flag for fixed (True) or expanded (False) input
+        kwargs          - Feature construction parameters
+    Returns:
+        Tuple of feature details (feature type, name, start, end) over both 
+        blocks, column ranges of TF-related feature types, column ranges of 
+        TF-unrelated features (within each block), and numbers of columns of 
+        both blocks
+    """
+    feat_details = []
+    tf_col_dict, nontf_col_dict = {}, {}
+    col_idx = 0
+    for feat_type in tf_feat_types:
+        width = get_feat_width(feat_type, is_fixed_input, **kwargs)
+        tf_col_dict[feat_type] = (col_idx, col_idx + width)
+        feat_details.append((feat_type, 'TF', col_idx, col_idx + width))
+        col_idx += width
+    n_tf_cols = col_idx
 
-    return tf_feat_mtx_dict, nontf_feat_mtx, feat_details, labels_dict
+    for feat_tuple in nontf_features:
+        width = get_feat_width(feat_tuple[0], is_fixed_input, **kwargs)
+        nontf_col_dict[feat_tuple] = (col_idx - n_tf_cols, col_idx - n_tf_cols + width)
+        feat_details.append(feat_tuple + (col_idx, col_idx + width))
+        col_idx += width
+    return feat_details, tf_col_dict, nontf_col_dict, n_tf_cols, col_idx - n_tf_cols
 
 
-def create_feat_mtx_parallel(features, h5_filepath, gene_map, is_fixed_input=True, **kwargs):
-    """Create feature matrix for each feautre in parallel
+def get_feat_width(feat_type, is_fixed_input=True, **kwargs):
+    """Get the number of columns of a feature, given the binning parameters.
     """
-    mp_dict = mp.Manager().dict()
-    mp_jobs = []
-    ## Define parallel jobs
-    for feat_tuple in features:
-        mp_job = mp.Process(
-            target=create_feat_mtx_wrapper, 
-            args=(mp_dict, feat_tuple, h5_filepath, gene_map, is_fixed_input),
-            kwargs=kwargs
-        )
-        mp_jobs.append(mp_job)
-    ## Execute parallel jobs
-    _ = [p.start() for p in mp_jobs]
-    _ = [p.join() for p in mp_jobs]
+    if feat_type == 'gene_expression' or feat_type == 'dna_sequence_nt_freq':
+        return 1
+    if is_fixed_input:
+        feat_bins = kwargs.get('feat_bins', None)
+        return feat_bins if feat_bins is not None else kwargs.get('feat_length', None)
+    bins = create_ext_bins(
+        kwargs.get('promo_bound', 0), kwargs.get('enhan_bound', None), 
+        kwargs.get('promo_width', 0), kwargs.get('enhan_min_width', None))
+    return len(bins)
+
+
+def assemble_feat_mtx(tfs, tf_features, nontf_features, h5_filepath, gene_map, n_genes,
+                    is_fixed_input=True, is_sparse=False, cache_dir=None, 
+                    n_workers=FEAT_MTX_WORKERS, mem_gb=FEAT_MTX_MEM_GB, **kwargs):
+    """Build all features and assemble them into one TF-related matrix per TF and
+    one TF-unrelated matrix, following the column layout planned up front. Dense
+    matrices are preallocated as memory-mapped buffers, into whose column slices
+    the feature workers write directly; sparse matrices are assembled by 
+    concatenating csc components once.
+    Returns:
+        Tuple of TF-related feature matrix dictionary, TF-unrelated feature 
+        matrix, and feature details
+    """
+    tf_feat_types = sorted(set([x[0] for x in tf_features]))
+    feat_details, tf_col_dict, nontf_col_dict, n_tf_cols, n_nontf_cols = plan_feat_layout(
+        tf_feat_types, nontf_features, is_fixed_input, **kwargs)
+    tf_features = [(feat_type, tf) for tf in tfs for feat_type in tf_feat_types]
+    features = tf_features + list(nontf_features)
+
+    if is_sparse:
+        mp_dict = create_feat_mtx_parallel(
+            features, h5_filepath, gene_map, is_fixed_input, cache_dir,
+            n_workers=n_workers, mem_gb=mem_gb, **kwargs)
+        tf_feat_mtx_dict = {tf: convert_feat_mtx_format(concat_csc_mtx(
+            [mp_dict[(feat_type, tf)] for feat_type in tf_feat_types], n_genes), True) for tf in tfs}
+        nontf_feat_mtx = convert_feat_mtx_format(concat_csc_mtx(
+            [mp_dict[x] for x in nontf_features], n_genes), True)
+        return tf_feat_mtx_dict, nontf_feat_mtx, feat_details
+
+    shared_dir = create_shared_dir(prefix='tfpr_layout_')
+    try:
+        ## Column-major buffers, so that the columns of a feature are contiguous
+        tf_specs = {tf: create_shared_buffer(
+            (n_genes, n_tf_cols), shared_dir, 'tf_X.{}'.format(i)) for i, tf in enumerate(tfs)}
+        nontf_spec = create_shared_buffer((n_genes, n_nontf_cols), shared_dir, 'nontf_X')
+        out_dict = {(feat_type, tf): (tf_specs[tf],) + tf_col_dict[feat_type] for feat_type, tf in tf_features}
+        out_dict.update({x: (nontf_spec,) + nontf_col_dict[x] for x in nontf_features})
+
+        create_feat_mtx_parallel(
+            features, h5_filepath, gene_map, is_fixed_input, cache_dir, out_dict=out_dict,
+            n_workers=n_workers, mem_gb=mem_gb, **kwargs)
+        tf_feat_mtx_dict = {tf: np.ascontiguousarray(load_shared_mtx(tf_specs[tf])) for tf in tfs}
+        nontf_feat_mtx = np.ascontiguousarray(load_shared_mtx(nontf_spec))
+    finally:
+        remove_shared_dir(shared_dir)
+    return tf_feat_mtx_dict, nontf_feat_mtx, feat_details
+
+
+def concat_csc_mtx(mtxs, n_rows):
+    """Concatenate csc matrices horizontally by joining their components once.
+    """
+    mtxs = [sps.csc_matrix(x) for x in mtxs]
+    if len(mtxs) == 0:
+        return sps.csc_matrix((n_rows, 0))
+    nnz_offsets = np.cumsum([0] + [x.nnz for x in mtxs[:-1]])
+    indptr = np.concatenate(
+        [[0]] + [x.indptr[1:].astype(np.int64) + offset for x, offset in zip(mtxs, nnz_offsets)])
+    return sps.csc_matrix(
+        (np.concatenate([x.data for x in mtxs]), np.concatenate([x.indices for x in mtxs]), indptr),
+        shape=(n_rows, sum([x.shape[1] for x in mtxs])))
+
+
+def create_feat_mtx_parallel(features, h5_filepath, gene_map, is_fixed_input=True, 
+                            cache_dir=None, out_dict=None, n_workers=FEAT_MTX_WORKERS, 
+                            mem_gb=FEAT_MTX_MEM_GB, **kwargs):
+    """Create feature matrix for each feautre in parallel. If cache directory is
+    given, reuse feature matrices built by previous runs. The number of worker
+    processes is bounded by the number of cores and the memory budget, and 
+    workers return matrices as csc components in memory-mapped files. Features
+    in `out_dict` (feature -> (buffer spec, start column, end column)) are 
+    instead written into the column slice of a shared dense buffer.
+    """
+    n_workers = estimate_feat_mtx_workers(features, h5_filepath, n_workers, mem_gb)
+    logger.info('Building {} feature matrices with {} workers'.format(len(features), n_workers))
+
+    mp_dict = {}
+    shared_dir = create_shared_dir(prefix='tfpr_feat_')
+    try:
+        ## Each worker process builds a single feature, so memory is released in between
+        with mp.Pool(processes=n_workers, maxtasksperchild=1) as pool:
+            mp_results = [pool.apply_async(
+                create_feat_mtx_wrapper, 
+                args=(shared_dir, feat_tuple, h5_filepath, gene_map, is_fixed_input, cache_dir,
+                    out_dict.get(feat_tuple, None) if out_dict is not None else None),
+                kwds=kwargs) for feat_tuple in features]
+            for feat_tuple, mp_result in zip(features, mp_results):
+                spec = mp_result.get()
+                if spec is not None:
+                    mp_dict[feat_tuple] = load_shared_mtx(spec, mmap_mode=None)
+    finally:
+        remove_shared_dir(shared_dir)
+    ## Limit the size of cache
+    if cache_dir is not None:
+        evict_feat_cache(cache_dir)
     return mp_dict
 
 
-def create_feat_mtx_wrapper(D, k, h5_filepath, gene_map, is_fixed_input, **kwargs):
-    """Wrapper for create_feat_mtx.
+def estimate_feat_mtx_workers(features, h5_filepath, n_workers=FEAT_MTX_WORKERS, 
+                            mem_gb=FEAT_MTX_MEM_GB):
+    """Estimate the number of processes for building feature matrices, bounded
+    by the number of cores, the number of features, and the memory budget 
+    given the largest h5 dataset.
     """
-    if is_fixed_input:
-        D[k] = create_fixed_feat_mtx(h5_filepath, k, gene_map, **kwargs)
-    else:
-        D[k] = create_expanded_feat_mtx(h5_filepath, k, gene_map, **kwargs)
+    n_workers = n_workers if n_workers > 0 else mp.cpu_count()
+    with h5py.File(h5_filepath, 'r') as f:
+        max_bytes = max([0] + [
+            f['{}/{}'.format(*x)].size * f['{}/{}'.format(*x)].dtype.itemsize for x in features])
+    if max_bytes > 0:
+        n_workers = min(n_workers, int(mem_gb * 1024 ** 3 // (max_bytes * FEAT_MTX_MEM_FACTOR)))
+    return max(1, min(n_workers, len(features)))
+
+
+def create_feat_mtx_wrapper(shared_dir, k, h5_filepath, gene_map, is_fixed_input, cache_dir=None, 
+                            out=None, **kwargs):
+    """Wrapper for create_feat_mtx. The matrix is written into the shared 
+    directory as csc components, and its spec is returned. If the output 
+    (buffer spec, start column, end column) is given, the matrix is written 
+    into the column slice of the buffer instead.
+    """
+    mtx = None
+    if cache_dir is not None:
+        cache_key = create_feat_cache_key(h5_filepath, k, gene_map, is_fixed_input, **kwargs)
+        mtx = load_cached_feat_mtx(cache_dir, k, cache_key)
+        if mtx is not None:
+            logger.info('Loaded cached feature: {} > {}'.format(k[0], k[1]))
+
+    if mtx is None:
+        if is_fixed_input:
+            mtx = create_fixed_feat_mtx(h5_filepath, k, gene_map, **kwargs)
+        else:
+            mtx = create_expanded_feat_mtx(h5_filepath, k, gene_map, **kwargs)
+        if cache_dir is not None:
+            save_cached_feat_mtx(cache_dir, k, cache_key, mtx)
+
+    if out is not None:
+        spec, start, end = out
+        if mtx.shape[1] != end - start:
+            raise ValueError('Feature {} > {} has {} columns, {} planned'.format(
+                k[0], k[1], mtx.shape[1], end - start))
+        X = load_shared_mtx(spec, mmap_mode='r+')
+        X[:, start:end] = mtx.toarray()
+        X.flush()
+        return None
+    return create_shared_mtx(mtx, shared_dir, '{}__{}'.format(*k), sparse_format='csc')
 
 
 def create_fixed_feat_mtx(filepath, feat_tuple, gene_map, **kwargs):
@@ -218,15 +404,14 @@ def create_fixed_feat_mtx(filepath, feat_tuple, gene_map, **kwargs):
     else:
         ## Build genomic location dependent feature
         mtx = map_feature_mtx_gene_index(mtx, gene_map)
-        mtx = convert_cont_adjmtx(mtx)
         ## Quantize feature matrix
         if feat_bins is not None:
             bin_width = feat_length / feat_bins
-            mtx = quantize_feature_mtx(mtx, bin_width)
-            feat_width = feat_bins
+            mtx = quantize_interval_mtx(mtx, bin_width)
         else:
-            feat_width = feat_length
-    mtx = convert_adjmtx_to_sparsemtx(mtx, len(gene_map), feat_width)
+            mtx = quantize_interval_mtx(mtx, 1)
+        feat_width = get_feat_width(feat_type, True, **kwargs)
+    mtx = convert_adjmtx_to_sparsemtx(mtx, count_mapped_genes(gene_map), feat_width)
     return mtx
 
 
@@ -239,6 +424,7 @@ def create_expanded_feat_mtx(filepath, feat_tuple, gene_map, **kwargs):
     pwidth = kwargs.get('promo_width', 0)
     ebound = kwargs.get('enhan_bound', None)
     ewidth = kwargs.get('enhan_min_width', None)
+    backend = kwargs.get('bin_backend', 'numpy')
 
     logger.info('Calculating feature: {} > {}'.format(feat_type, feat_name))
 
@@ -254,9 +440,9 @@ def create_expanded_feat_mtx(filepath, feat_tuple, gene_map, **kwargs):
         ## Build coordinate dependent feature
         mtx = map_feature_mtx_gene_index(mtx, gene_map)
         ## Map features into bins
-        mtx = map_feature_mtx_to_bins(mtx, bins)
+        mtx = map_feature_mtx_to_bins(mtx, bins, backend=backend)
         feat_width = len(bins)
-    mtx = convert_adjmtx_to_sparsemtx(mtx, len(gene_map), feat_width)
+    mtx = convert_adjmtx_to_sparsemtx(mtx, count_mapped_genes(gene_map), feat_width)
     return mtx
 
 
@@ -304,8 +490,75 @@ def create_exponential_bins(start, stop, w, is_upstream=False):
     return bins
 
 
-def map_feature_mtx_to_bins(mtx, bins, shift=10 ** 7):
+def map_feature_mtx_to_bins(mtx, bins, backend='numpy', shift=10 ** 7):
     """Map coordinate dependent features into bins of regulatory regions.
+    Args:
+        mtx         - 4-col numpy matrix, whose row is (gene index, start, end, value)
+        bins        - 2-col numpy matrix, whose row is (bin start, bin end)
+        backend     - Interval engine. Choose from `numpy` (in-process) and
+                    `bedtool` (reference implementation using bedtools)
+        shift       - Coordinate shift to make bed coordinates non-negative
+                    (only used by `bedtool` backend)
+    Returns:
+        3-col numpy matrix, whose row is (gene index, bin index, value)
+    """
+    if backend == 'numpy':
+        return map_feature_mtx_to_bins_numpy(mtx, bins)
+    elif backend == 'bedtool':
+        return map_feature_mtx_to_bins_bedtool(mtx, bins, shift)
+    raise ValueError('Unknown binning backend: {}'.format(backend))
+
+
+def map_feature_mtx_to_bins_numpy(mtx, bins):
+    """Map coordinate dependent features into bins using sorted bin edges. 
+    A feature wider than a bin is split into bins with its score divided by 
+    the fraction of the feature overlapping each bin, same as the bedtool 
+    backend. Bins must not overlap each other.
+    """
+    bins = np.asarray(bins, dtype=int)
+    if len(mtx) == 0 or len(bins) == 0:
+        return np.empty((0, 3))
+
+    ## Sort bins by start, and remember the original bin index
+    order = np.argsort(bins[:, 0], kind='stable')
+    b_start, b_end = bins[order, 0], bins[order, 1]
+    if np.any(b_start[1:] < b_end[:-1]):
+        raise ValueError('Bins must not overlap for numpy binning backend.')
+
+    gene = mtx[:, 0].astype(int)
+    start = mtx[:, 1].astype(int)
+    end = mtx[:, 2].astype(int)
+    score = mtx[:, 3].astype(float)
+
+    ## Find the range of bins [lo, hi) overlapped by each feature, i.e.
+    ## bin end > feature start and bin start < feature end
+    lo = np.searchsorted(b_end, start, side='right')
+    hi = np.searchsorted(b_start, end, side='left')
+    n_hits = np.maximum(hi - lo, 0)
+    n_hits[end <= start] = 0
+
+    ## Expand each feature into (feature, bin) pairs
+    feat_idx = np.repeat(np.arange(len(mtx)), n_hits)
+    offsets = np.arange(len(feat_idx)) - np.repeat(np.cumsum(n_hits) - n_hits, n_hits)
+    bin_pos = lo[feat_idx] + offsets
+
+    ## Divide the score if a feature is wider than a bin
+    seg_start = np.maximum(start[feat_idx], b_start[bin_pos])
+    seg_end = np.minimum(end[feat_idx], b_end[bin_pos])
+    seg_frac = (seg_end - seg_start) / (end[feat_idx] - start[feat_idx])
+    seg_score = score[feat_idx] * seg_frac
+
+    ## Sum scores within each bin
+    n_bins = len(bins)
+    keys = gene[feat_idx].astype(np.int64) * n_bins + order[bin_pos]
+    uniq_keys, inverse = np.unique(keys, return_inverse=True)
+    sums = np.bincount(inverse.ravel(), weights=seg_score, minlength=len(uniq_keys))
+    return np.column_stack((uniq_keys // n_bins, uniq_keys % n_bins, sums))
+
+
+def map_feature_mtx_to_bins_bedtool(mtx, bins, shift=10 ** 7):
+    """Map coordinate dependent features into bins of regulatory regions using
+    bedtools intersect.
     """
     ## Convert feature matrix and bin vector into bed
     f_len = mtx.shape[0]
@@ -346,8 +599,10 @@ def map_feature_mtx_to_bins(mtx, bins, shift=10 ** 7):
     return mb[['gene', 'bin', 'segScore']].values
 
 
-def create_model_label(filepath, tf, genes, is_long_csv=False, tf_col=None, gene_col=None):
-    """Create label vector matching gene list.
+def create_model_label(filepath, tf, genes, is_long_csv=False, tf_col=None, gene_col=None, 
+                        store_dir=None):
+    """Create label vector matching gene list. The label file is parsed once
+    per process and served from its label store.
     Args:
         filepath        - Filepath of label csv matrix
         tf              - Column (Transcription factor) of interest
@@ -355,31 +610,16 @@ def create_model_label(filepath, tf, genes, is_long_csv=False, tf_col=None, gene
         is_long_csv     - csv file in long (True) or wide (False) format
         tf_col          - Column name for TFs
         gene_col        - Column name for genes
+        store_dir       - Directory to persist the label store
     Returns:
         Label dataframe
     """
     #TOOD: Unify label csv as long format.
-    if is_long_csv:
-        df = pd.read_csv(filepath)
-        if tf not in df[tf_col].unique():
-            logger.error('TF {} not found in label file. ==> Aborted <=='.format(tf))
-            sys.exit(1)
-
-        cols = [gene_col, 'log2FoldChange'] 
-        if 'padj' in df.columns:
-            cols.append('padj')
-        label_df = df.loc[df[tf_col] == tf, cols]
-        label_df = label_df.set_index(gene_col)
-    
-    else:
-        df = pd.read_csv(filepath, index_col=0)
-        if tf not in df.columns:
-            logger.error('TF {} not found in label file. ==> Aborted <=='.format(tf))
-            sys.exit(1)
-
-        label_df = df[tf]
-    label_df = map_label_gene_index(label_df, genes)
-    return label_df
+    label_store = load_label_store(filepath, is_long_csv, tf_col, gene_col, store_dir)
+    if tf not in label_store.tfs:
+        logger.error('TF {} not found in label file. ==> Aborted <=='.format(tf))
+        sys.exit(1)
+    return label_store.get_label(tf, genes)
 
 
 def get_h5_features(h5_filepath, feat_types, tfs):
@@ -433,90 +673,129 @@ def list_h5_datasets(filepath, feat_type):
         return list(f[feat_type].keys())
 
 
-def load_csv_genes(filepath, is_long_csv, gene_col):
-    """Load gene list from matrix.
+def load_csv_genes(filepath, is_long_csv, gene_col, tf_col=None, store_dir=None):
+    """Load gene list from matrix, served from the label store.
     """
-    if is_long_csv:
-        df = pd.read_csv(filepath)
-        genes = sorted(df[gene_col].unique())
-    else:
-        df = pd.read_csv(filepath, usecols=[0], index_col=0)
-        genes = df.index.tolist()
-    return genes
+    return list(load_label_store(filepath, is_long_csv, tf_col, gene_col, store_dir).genes)
 
 
-def create_gene_index_map(h5_filepath, csv_filepath, is_long_csv=False, gene_col=None):
+def create_gene_index_map(h5_filepath, csv_filepath, is_long_csv=False, gene_col=None,
+                        tf_col=None, store_dir=None):
     """Map gene index of h5 and gene index of csv to the common genes. 
     Args:
         h5_filepath     - h5 file for signals in regulatory regions 
         csv_filepath    - csv file for label signals
         is_long_csv     - csv file in long (True) or wide (False) format
         gene_col        - Column name for genes
+        tf_col          - Column name for TFs
+        store_dir       - Directory to persist the label store
     Return: 
         Tuple (common_genes, h_map, c_map), representing the common genes in the 
-        intersection, and index dictionaries for mapping h5 genes and csv genes 
-        to common genes respectively.
+        intersection, and index arrays for mapping h5 genes and csv genes 
+        to common genes respectively (-1 if not common).
     """
     h_genes = load_h5_genes(h5_filepath)
-    c_genes = load_csv_genes(csv_filepath, is_long_csv, gene_col)
+    c_genes = load_csv_genes(csv_filepath, is_long_csv, gene_col, tf_col, store_dir)
     common_genes = sorted(set(h_genes) & set(c_genes))
-    h_map = {h_genes.index(x): i for i, x in enumerate(common_genes)}
-    c_map = {c_genes.index(x): i for i, x in enumerate(common_genes)}
+    h_map = create_gene_remap(h_genes, common_genes)
+    c_map = create_gene_remap(c_genes, common_genes)
     return (common_genes, h_map, c_map)
 
 
+def create_gene_remap(genes, common_genes):
+    """Create an array mapping each gene index to the index of common genes, 
+    or -1 if the gene is not common. Only the first occurrence of a duplicated
+    gene is mapped.
+    """
+    first_idx = {}
+    for i, x in enumerate(genes):
+        first_idx.setdefault(x, i)
+    remap = np.full(len(genes), -1, dtype=np.int64)
+    remap[[first_idx[x] for x in common_genes]] = np.arange(len(common_genes))
+    return remap
+
+
+def count_mapped_genes(remap):
+    """Count the common genes of a gene index mapping array.
+    """
+    return int(np.count_nonzero(np.asarray(remap) >= 0))
+
+
 def map_feature_mtx_gene_index(mtx, D):
     """Filter and map the gene index (the first column of feature matrix)
-    based on index mapping dictionary.
+    based on index mapping array.
     Args:
         mtx     - Numpy matrix
-        D       - Index mapping dictionary
+        D       - Index mapping array (-1 for genes to be removed)
     Return:
         Numpy matrix
     """
-    ## Fitler current gene index
-    idx = np.argwhere(np.isin(mtx[:, 0], sorted(D.keys())))
-    mtx = mtx[idx.squeeze(), :]
-    ## Map to new gene index 
-    mtx[:, 0] = list(map(D.get, mtx[:, 0]))
+    gene_idx = mtx[:, 0].astype(np.int64)
+    is_valid = (gene_idx >= 0) & (gene_idx < len(D))
+    new_idx = np.full(len(gene_idx), -1, dtype=np.int64)
+    new_idx[is_valid] = D[gene_idx[is_valid]]
+    ## Fitler current gene index and map to new gene index
+    is_mapped = new_idx >= 0
+    mtx = mtx[is_mapped]
+    mtx[:, 0] = new_idx[is_mapped]
     return mtx
 
 
-def map_label_gene_index(df, genes):
-    """Filter and map the gene index of label dataframe.
-    """
-    return df.reindex(genes)
-
-
-def convert_cont_adjmtx(mtx):
-    """Transform feature matrix to continuous adjacency matrix, where the feature 
-    value is assigned to single base position.
-    """
-    mtx2 = []
-    for row in mtx:
-        i, start, end, val = row
-        i, start, end = int(i), int(start), int(end)
-        for j in range(start, end):
-            mtx2.append([i, j, val])
-    return np.array(mtx2)
-
-
-def quantize_feature_mtx(mtx, width):
-    """Bin features along genomic position, and aggregate values within each bin.
+def quantize_interval_mtx(mtx, width):
+    """Bin features along genomic position directly from their intervals, and
+    aggregate values within each bin. Each base position j of an interval 
+    [start, end) contributes the interval's value to bin floor(j / width), so 
+    a bin sums value x overlapping length, without expanding every position.
     Args:
-        mtx     - 4-col numpy matrix, whose row is (gene index, strat, end, value)
+        mtx     - 4-col numpy matrix, whose row is (gene index, start, end, value)
         width   - Width of bin
     Returns:
         3-col numpy matrix, whose row is (gene index, bin index, value)
     """
-    mtx2 = []
-    df = pd.DataFrame(mtx)
-    for i, subdf in df.groupby(0):
-        subdf2 = subdf.groupby(subdf[1] // width)[2].sum()
-        m1 = i * np.ones(subdf2.shape[0]).reshape(-1, 1)
-        m2 = subdf2.reset_index().values
-        mtx2 += np.hstack((m1, m2)).tolist()
-    return np.array(mtx2)
+    if len(mtx) == 0:
+        return np.empty((0, 3))
+    gene = mtx[:, 0].astype(int)
+    start = mtx[:, 1].astype(int)
+    end = mtx[:, 2].astype(int)
+    val = mtx[:, 3]
+
+    ## Find the first and last bins covered by each interval
+    valid = end > start
+    gene, start, end, val = gene[valid], start[valid], end[valid], val[valid]
+    first_bin = np.floor_divide(start, width).astype(int)
+    last_bin = np.floor_divide(end - 1, width).astype(int)
+    n_bins = last_bin - first_bin + 1
+
+    ## Expand each interval into (interval, bin) pairs
+    row_idx = np.repeat(np.arange(len(gene)), n_bins)
+    offsets = np.arange(len(row_idx)) - np.repeat(np.cumsum(n_bins) - n_bins, n_bins)
+    bin_idx = first_bin[row_idx] + offsets
+
+    ## Count the base positions of each interval falling into each bin
+    seg_start = np.maximum(start[row_idx], find_bin_first_position(bin_idx, width))
+    seg_end = np.minimum(end[row_idx], find_bin_first_position(bin_idx + 1, width))
+    seg_val = val[row_idx] * np.maximum(seg_end - seg_start, 0)
+
+    ## Sum values within each (gene, bin)
+    if len(bin_idx) == 0:
+        return np.empty((0, 3))
+    bin_min = bin_idx.min()
+    bin_span = bin_idx.max() - bin_min + 1
+    keys = gene[row_idx].astype(np.int64) * bin_span + (bin_idx - bin_min)
+    uniq_keys, inverse = np.unique(keys, return_inverse=True)
+    sums = np.bincount(inverse.ravel(), weights=seg_val, minlength=len(uniq_keys))
+    return np.column_stack((uniq_keys // bin_span, uniq_keys % bin_span + bin_min, sums))
+
+
+def find_bin_first_position(bin_idx, width):
+    """Find the first integer position j such that floor(j / width) >= bin index,
+    i.e. the first base position assigned to the bin.
+    """
+    pos = np.ceil(bin_idx * width).astype(int)
+    ## Correct floating point rounding of bin edges
+    pos = np.where(np.floor_divide(pos - 1, width) >= bin_idx, pos - 1, pos)
+    pos = np.where(np.floor_divide(pos, width) < bin_idx, pos + 1, pos)
+    return pos
 
 
 def convert_adjmtx_to_sparsemtx(mtx, gene_num, feat_len):
@@ -532,6 +811,166 @@ def convert_adjmtx_to_sparsemtx(mtx, gene_num, feat_len):
     return sps.csc_matrix((mtx[:, 2], (mtx[:, 0], mtx[:, 1])), shape=csc_shape)
 
 
+def convert_feat_mtx_format(mtx, is_sparse=False):
+    """Convert the concatenated feature matrix into dense numpy matrix, or csr
+    matrix without explicitly stored zeros.
+    """
+    if not is_sparse:
+        return mtx.toarray()
+    mtx = sps.csr_matrix(mtx)
+    mtx.eliminate_zeros()
+    return mtx
+
+
+def convert_sparse_to_dense(X, fill_value=np.nan):
+    """Convert sparse matrix to dense matrix, in which the entries not stored
+    in sparse matrix are filled with `fill_value`. XGBoost treats the unstored 
+    entries of a sparse matrix as missing values, so NaN keeps a dense copy 
+    consistent with the model trained on sparse input.
+    """
+    if not sps.issparse(X):
+        return X
+    X = X.tocoo()
+    X_dense = np.full(X.shape, fill_value, dtype=float)
+    X_dense[X.row, X.col] = X.data
+    return X_dense
+
+
+class FactorizedDesignMatrix:
+    """Design matrix of stacked (TF, gene) rows, factorized into a TF-related 
+    feature block with one row per (TF, gene), and a TF-unrelated feature block
+    with one row per gene shared by all TFs. Row i of the full design matrix is
+    the concatenation of tf_X[i] and nontf_X[gene_idx[i]], which is only 
+    materialized on request or in row chunks.
+    """
+    def __init__(self, tf_X, nontf_X, gene_idx):
+        self.tf_X = tf_X
+        self.nontf_X = nontf_X
+        self.gene_idx = np.asarray(gene_idx, dtype=int)
+        self.is_sparse = sps.issparse(tf_X) or sps.issparse(nontf_X)
+        self.shape = (tf_X.shape[0], tf_X.shape[1] + nontf_X.shape[1])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def take(self, rows, dtype=np.float32):
+        """Materialize the selected rows of the design matrix.
+        """
+        rows = np.asarray(rows, dtype=int)
+        if self.is_sparse:
+            return sps.hstack(
+                [sps.csr_matrix(self.tf_X[rows]), sps.csr_matrix(self.nontf_X[self.gene_idx[rows]])],
+                format='csr', dtype=dtype)
+        return self.fill(np.empty((len(rows), self.shape[1]), dtype=dtype), rows)
+
+    def fill(self, out, rows=None, chunk_size=10000):
+        """Write the (selected rows of) dense design matrix into a preallocated
+        buffer, copying the TF-unrelated block in row chunks.
+        """
+        rows = np.arange(self.shape[0]) if rows is None else rows
+        n_tf_feats = self.tf_X.shape[1]
+        for i in range(0, len(rows), chunk_size):
+            chunk_rows = rows[i:i + chunk_size]
+            out[i:i + len(chunk_rows), :n_tf_feats] = self.tf_X[chunk_rows]
+            out[i:i + len(chunk_rows), n_tf_feats:] = self.nontf_X[self.gene_idx[chunk_rows]]
+        return out
+
+    def to_matrix(self, dtype=np.float32, chunk_size=10000):
+        """Materialize the full design matrix in one preallocated buffer 
+        (dense) or csr matrix, filled in row chunks.
+        """
+        if not self.is_sparse:
+            return self.fill(np.empty(self.shape, dtype=dtype), chunk_size=chunk_size)
+
+        ## Allocate csr arrays by the number of stored entries of each row
+        row_nnz = count_row_nnz(self.tf_X) + count_row_nnz(self.nontf_X)[self.gene_idx]
+        indptr = np.zeros(self.shape[0] + 1, dtype=np.int64)
+        np.cumsum(row_nnz, out=indptr[1:])
+        data = np.empty(indptr[-1], dtype=dtype)
+        indices = np.empty(indptr[-1], dtype=np.int32)
+        for start, stop, X_chunk in self.iter_chunks(chunk_size, dtype):
+            data[indptr[start]:indptr[stop]] = X_chunk.data
+            indices[indptr[start]:indptr[stop]] = X_chunk.indices
+        return sps.csr_matrix((data, indices, indptr), shape=self.shape)
+
+    def iter_chunks(self, chunk_size, dtype=np.float32):
+        """Iterate the design matrix in row chunks as (start, stop, matrix).
+        """
+        for start in range(0, self.shape[0], chunk_size):
+            stop = min(start + chunk_size, self.shape[0])
+            yield start, stop, self.take(np.arange(start, stop), dtype)
+
+
+def count_row_nnz(X):
+    """Count the stored entries (sparse) or nonzeros (dense) of each row.
+    """
+    if sps.issparse(X):
+        return X.getnnz(axis=1)
+    return np.count_nonzero(X, axis=1)
+
+
+def create_shared_dir(prefix='tfpr_'):
+    """Create a temporary directory for memory-mapped arrays shared across 
+    processes.
+    """
+    dirpath = TMP_PATH if os.path.isdir(TMP_PATH) else None
+    return tempfile.mkdtemp(prefix=prefix, dir=dirpath)
+
+
+def remove_shared_dir(dirpath):
+    shutil.rmtree(dirpath, ignore_errors=True)
+
+
+def create_shared_mtx(X, dirpath, name, sparse_format='csr'):
+    """Write a dense or sparse matrix into memory-mapped npy file(s), so that
+    worker processes can map it instead of receiving a pickled copy.
+    Args:
+        X               - Numpy matrix or scipy sparse matrix
+        dirpath         - Directory for the npy files
+        name            - Name of the matrix
+        sparse_format   - Format of sparse matrix, `csr` or `csc`
+    Returns:
+        Spec dictionary to load the shared matrix
+    """
+    if sps.issparse(X):
+        X = X.asformat(sparse_format)
+        spec = {'format': sparse_format, 'shape': X.shape}
+        for k in ['data', 'indices', 'indptr']:
+            spec[k] = create_shared_mtx(getattr(X, k), dirpath, '{}.{}'.format(name, k))
+        return spec
+
+    filepath = '{}/{}.npy'.format(dirpath, name)
+    X = np.asarray(X)
+    mm = np.lib.format.open_memmap(filepath, mode='w+', dtype=X.dtype, shape=X.shape)
+    mm[...] = X
+    mm.flush()
+    del mm
+    return {'format': 'dense', 'filepath': filepath}
+
+
+def create_shared_buffer(shape, dirpath, name, dtype=np.float64):
+    """Create a zero-filled, column-major npy file to be written by worker 
+    processes, and return its spec.
+    """
+    filepath = '{}/{}.npy'.format(dirpath, name)
+    mm = np.lib.format.open_memmap(
+        filepath, mode='w+', dtype=dtype, shape=shape, fortran_order=True)
+    del mm
+    return {'format': 'dense', 'filepath': filepath}
+
+
+def load_shared_mtx(spec, mmap_mode='r'):
+    """Load a shared matrix as read-only memory map, or in memory if mmap_mode
+    is None.
+    """
+    if spec['format'] in ['csr', 'csc']:
+        sp_mtx = sps.csr_matrix if spec['format'] == 'csr' else sps.csc_matrix
+        return sp_mtx(
+            tuple(load_shared_mtx(spec[k], mmap_mode) for k in ['data', 'indices', 'indptr']),
+            shape=spec['shape'], copy=False)
+    return np.load(spec['filepath'], mmap_mode=mmap_mode)
+
+
 def create_expr_vector(mtx):
     """Create expression profile as a feature vector.
     """
@@ -551,7 +990,9 @@ def standardize_feat_mtx(X_tr, X_te, method='zscore'):
     Args:
         X_tr        - Feature matrix for training
         X_te        - Feature matrix for test
-        method      - Standardization method. Choose from `zscore` and `minmax`.
+        method      - Standardization method. Choose from `zscore`, `minmax`, 
+                    and `scale` (unit variance without centering, which keeps 
+                    sparse matrices sparse).
     Returns:
         Standarized feature matrix
     """
@@ -572,12 +1013,37 @@ def standardize_feat_mtx(X_tr, X_te, method='zscore'):
 def standardize_2d_feat_mtx(X_tr, X_te, method):
     """Standardize 2D feature matrix using Z-score (zero mean and std dev). 
     """
+    scaler = fit_feat_scaler(X_tr, method)
+    X_tr_xform = transform_feat_mtx(X_tr, scaler)
+    X_te_xform = transform_feat_mtx(X_te, scaler) if X_te is not None else None
+    return X_tr_xform, X_te_xform
+
+
+def fit_feat_scaler(X, method='zscore'):
+    """Fit the scaler of 2D feature matrix. Return None if there is no feature.
+    """
+    if X.shape[1] == 0:
+        return None
     if method.lower() == 'zscore':
         scaler = StandardScaler()
     elif method.lower() == 'minmax':
         scaler = MinMaxScaler()
-    scaler.fit(X_tr)
-    return scaler.transform(X_tr), scaler.transform(X_te) if X_te is not None else None
+    elif method.lower() == 'scale':
+        scaler = StandardScaler(with_mean=False)
+    scaler.fit(X)
+    return scaler
+
+
+def transform_feat_mtx(X, scaler):
+    """Transform 2D feature matrix using fitted scaler. Keep csr format for 
+    sparse matrix.
+    """
+    if scaler is None:
+        return X
+    X_xform = scaler.transform(X)
+    if sps.issparse(X_xform):
+        X_xform = sps.csr_matrix(X_xform)
+    return X_xform
 
 
 def binarize_label(y, lfc_cutoff=None, p_cutoff=None):
@@ -629,8 +1095,8 @@ def create_random_input(X, y, n_samples=1000):
 def compile_mp_results(mp_dicts):
     """Compile the array of dicts into one dict.
     """
-    result_dict = {d: [] for d in ['preds', 'stats', 'models']}
+    result_dict = {}
     for k in sorted(mp_dicts.keys()):
-        for d in result_dict.keys():
-            result_dict[d].append(mp_dicts[k].get()[d])
+        for d, v in mp_dicts[k].get().items():
+            result_dict.setdefault(d, []).append(v)
     return result_dict
@@ -1,4 +1,5 @@
 import sys
+import time
 import os.path
 import argparse
 import configparser
@@ -8,8 +9,10 @@ import pandas as pd
 from pybedtools import BedTool
 import logging.config
 
-from data_preproc_utils import create_regdna, intersect_peak_regdna, \
-    calculate_matrix_position, get_onehot_dna_sequence, get_nt_frequency
+from data_preproc_utils import IndexedGenome, generate_peak_tracks, create_regdna, \
+    intersect_peak_regdna, calculate_matrix_position, get_onehot_dna_sequence, get_nt_frequency, \
+    check_feature_genes, is_feature_current, remove_feature_datasets, \
+    remove_stale_feature_datasets, write_feature_dataset
 
 ## Intialize logger
 logging.config.fileConfig('logging.ini', disable_existing_loggers=False)
@@ -52,6 +55,21 @@ def parse_args(argv):
         '--feat_bound', nargs='*', type=int, 
         default=(FEAT_UPSTREAM_BOUND, FEAT_DOWNSTREAM_BOUND),
         help='Distance of upstream and downstream boundaries to TSS (in tuple).')
+    parser.add_argument(
+        '--nt_freq_k', nargs='*', type=int, default=[2],
+        help='Length(s) of k-mers (1-6) for DNA sequence composition features (default: 2, i.e. di-nucleotides).')
+    parser.add_argument(
+        '--nt_freq_strand_specific', action='store_true',
+        help='Keep k-mers and their reverse complements as separate features.')
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='Update an existing output hdf5 file, computing only the datasets that are missing or whose source files or parameters changed.')
+    parser.add_argument(
+        '--intersect_backend', default='bedtools', choices=['bedtools', 'numpy'],
+        help='Peak-region intersection by bedtools (default), or by sorted intervals in numpy without bedtools.')
+    parser.add_argument(
+        '-p', '--n_workers', type=int, default=1,
+        help='Number of worker processes for peak tracks (default: 1; 0 for all cores).')
     parsed = parser.parse_args(argv[1:])
     return parsed
 
@@ -85,7 +103,8 @@ def parse_features(args):
     return D
 
 
-def generate_features(h5, gene_annot, reg_bound, feat_dict):
+def generate_features(h5, gene_annot, reg_bound, feat_dict, nt_freq_ks=(2,), collapse_revcomp=True, 
+                      n_workers=1, incremental=False, intersect_backend='bedtools'):
     """Generate datasets for all features in hdf5 file.
     Args:
         h5          - h5 filename
@@ -93,6 +112,12 @@ def generate_features(h5, gene_annot, reg_bound, feat_dict):
         reg_bound   - Tuple for the boundary of regulatory region, i.e.
                         (upstream distance, downstream distance)
         feat_dict   - Dictionary of feature types and feature names
+        nt_freq_ks  - Lengths of k-mers for sequence composition features
+        collapse_revcomp    - Boolean flag for combining reverse complement k-mers
+        n_workers   - Number of worker processes for peak tracks
+        incremental - Boolean flag for updating an existing hdf5 file, in which
+                    only missing or outdated datasets are computed
+        intersect_backend   - Peak-region intersection by `bedtools` or `numpy`
     Returns:
         NULL
     """
@@ -101,75 +126,115 @@ def generate_features(h5, gene_annot, reg_bound, feat_dict):
     ## Parse gene list and regulator DNA
     gene_bed = BedTool(gene_annot)
     genes = sorted(pd.unique(gene_bed.to_dataframe()['name']))
-    regdna_bed = create_regdna(gene_bed, feat_dict['dna_sequence'], reg_bound)
+    ## Genome is indexed once and shared by all sequence features
+    genome = IndexedGenome(feat_dict['dna_sequence'])
+    regdna_bed = create_regdna(gene_bed, genome, reg_bound)
+    ## Regulatory DNA depends on gene annotation, genome and boundary
+    regdna_sources = [feat_dict['dna_sequence'], gene_annot]
+    regdna_params = {'reg_bound': [int(x) for x in reg_bound]}
 
     ## Write grouped datasets into hdf5
-    with h5py.File(h5, 'w') as f:
+    peak_tracks = []
+    ## Feature units (group name, unit) in current input
+    units = set()
+    with h5py.File(h5, 'a' if incremental else 'w') as f:
         ## Gene list 
-        f.create_dataset(
-            'genes', 
-            data=np.array(genes, dtype='S'), 
-            compression='gzip')
+        if not check_feature_genes(f, genes):
+            logger.error('Genes in {} differ from gene annotation. ==> Aborted <=='.format(h5))
+            sys.exit(1)
 
         for k1, v1 in feat_dict.items(): 
             ## Regulatory DNA sequence
             if k1 == 'dna_sequence': 
-                logger.info('Working on {} {}'.format(k1, v1))
                 ## Store one-hot encode sequence in A, C, G, T channels
-                # logger.debug('... one-hot DNA')
-                regdna_df = get_onehot_dna_sequence(regdna_bed, v1, reg_bound, genes)
-                g = f.require_group(k1)
-                for i, alphabet in enumerate(['A', 'C', 'G', 'T']):
-                    g.create_dataset(
-                        alphabet, 
-                        data=regdna_df.loc[regdna_df['alphabet'] == i, FEAT_COL].values.astype(int), 
-                        compression='gzip')
+                units.add((k1, k1))
+                if is_feature_current(f, k1, k1, regdna_sources, regdna_params):
+                    logger.info('Skipped {} {} (up to date)'.format(k1, v1))
+                else:
+                    logger.info('Working on {} {}'.format(k1, v1))
+                    remove_feature_datasets(f, k1, k1)
+                    regdna_df = get_onehot_dna_sequence(regdna_bed, genome, reg_bound, genes)
+                    for i, alphabet in enumerate(['A', 'C', 'G', 'T']):
+                        write_feature_dataset(
+                            f, k1, alphabet, 
+                            regdna_df.loc[regdna_df['alphabet'] == i, FEAT_COL].values.astype(int), 
+                            k1, regdna_sources, regdna_params, incremental)
+
                 # Store single and di-nucleotide frequencies
-                # logger.debug('... di-nucleotide freqs')
-                nt_freq_dict = get_nt_frequency(regdna_bed, v1, genes)
-                g = f.require_group(k1 + '_nt_freq')
-                for nt, freq_arr in nt_freq_dict.items():
-                    g.create_dataset(
-                        nt,
-                        data=np.array(freq_arr, dtype='float16'),
-                        compression='gzip')
+                k1_nt = k1 + '_nt_freq'
+                params = dict(regdna_params, nt_freq_ks=list(nt_freq_ks), collapse_revcomp=collapse_revcomp)
+                units.add((k1_nt, k1_nt))
+                if is_feature_current(f, k1_nt, k1_nt, regdna_sources, params):
+                    logger.info('Skipped {} (up to date)'.format(k1_nt))
+                else:
+                    logger.info('Working on {}'.format(k1_nt))
+                    remove_feature_datasets(f, k1_nt, k1_nt)
+                    nt_freq_dict = {}
+                    for k in nt_freq_ks:
+                        nt_freq_dict.update(get_nt_frequency(
+                            regdna_bed, genome, genes, k, collapse_revcomp))
+                    for nt, freq_arr in nt_freq_dict.items():
+                        write_feature_dataset(
+                            f, k1_nt, nt, np.array(freq_arr, dtype='float16'), 
+                            k1_nt, regdna_sources, params, incremental)
 
             ## Gene expression level features
             elif k1 == 'gene_expression' or k1 == 'gene_variation': 
                 for k2, v2 in v1.items():
+                    unit = '{}:{}'.format(k1, k2)
+                    units.add(('gene_expression', unit))
+                    if is_feature_current(f, 'gene_expression', unit, [v2]):
+                        logger.info('Skipped {} {} (up to date)'.format(k1, k2))
+                        continue
                     logger.info('Working on {} {}'.format(k1, k2))
-                    g = f.require_group('gene_expression')
+                    remove_feature_datasets(f, 'gene_expression', unit)
                     ## Load gene expression matrix and sort genes in the 
                     ## same dimension as other features
                     expr_df = pd.read_csv(v2, index_col=0)
                     expr_df = expr_df.loc[genes]
                     if k1 == 'gene_variation':
-                        g.create_dataset(
-                            'variation',
-                            data=expr_df.values[:, 0].astype(float),
-                            compression='gzip')
+                        write_feature_dataset(
+                            f, 'gene_expression', 'variation',
+                            expr_df.values[:, 0].astype(float), unit, [v2], 
+                            record_md5=incremental)
                     else:
                         ## Store individual gene expression profile
                         for sample in sorted(expr_df.columns):
-                            g.create_dataset(
-                                sample,
-                                data=expr_df[sample].values.astype(float),
-                                compression='gzip')
+                            write_feature_dataset(
+                                f, 'gene_expression', sample,
+                                expr_df[sample].values.astype(float), unit, [v2], 
+                                record_md5=incremental)
 
-            ## Epigenetic features, e.g. TF binding data
+            ## Epigenetic features, e.g. TF binding data, are processed below
             else: 
-                g = f.require_group(k1)
                 for k2, v2 in v1.items():  ## Feature name, e.g. TF name
-                    logger.info('Working on {} {}'.format(k1, k2))
-                    v2_bed = BedTool(v2)
-                    ## Intersect peak features with regulatory region
-                    feat_df = intersect_peak_regdna(v2_bed, regdna_bed, gene_bed.to_dataframe())
-                    feat_df = calculate_matrix_position(feat_df, reg_bound[0])
-                    feat_df['gene_idx'] = [genes.index(x) for x in feat_df['gene']]
-                    g.create_dataset(
-                        k2, 
-                        data=feat_df[FEAT_COL].values.astype(float), 
-                        compression='gzip')
+                    units.add((k1, '{}:{}'.format(k1, k2)))
+                    if is_feature_current(
+                            f, k1, '{}:{}'.format(k1, k2), [v2] + regdna_sources, regdna_params):
+                        logger.info('Skipped {} {} (up to date)'.format(k1, k2))
+                        continue
+                    peak_tracks.append((k1, k2, v2))
+
+        ## Intersect peak features with regulatory region in parallel, and 
+        ## write each track as soon as it is done
+        logger.info('Working on {} peak tracks with {} worker(s)'.format(
+            len(peak_tracks), n_workers))
+        start_time = time.time()
+        source_dict = {(k1, k2): v2 for k1, k2, v2 in peak_tracks}
+        for i, (k1, k2, feat_arr, elapsed) in enumerate(generate_peak_tracks(
+                peak_tracks, regdna_bed, gene_bed.to_dataframe(), genes, FEAT_COL, 
+                reg_bound[0], n_workers, intersect_backend)):
+            write_feature_dataset(
+                f, k1, k2, feat_arr, '{}:{}'.format(k1, k2), 
+                [source_dict[(k1, k2)]] + regdna_sources, regdna_params, incremental)
+            logger.info('[{}/{}] Done {} {} ({} peak-region overlaps, {:.1f}s)'.format(
+                i + 1, len(peak_tracks), k1, k2, feat_arr.shape[0], elapsed))
+        logger.info('Finished peak tracks in {:.1f}s'.format(time.time() - start_time))
+
+        ## Remove features whose source is no longer in the input
+        if incremental:
+            for unit in remove_stale_feature_datasets(f, units):
+                logger.info('Removed {} (not in input)'.format(unit))
 
 
 def main(argv):
@@ -179,7 +244,10 @@ def main(argv):
     feat_bound = args.feat_bound
     output_h5 = args.output_h5
 
-    generate_features(output_h5, gene_annotation, feat_bound, feature_dict)
+    generate_features(
+        output_h5, gene_annotation, feat_bound, feature_dict, 
+        args.nt_freq_k, not args.nt_freq_strand_specific, args.n_workers, 
+        args.incremental, args.intersect_backend)
 
 
 if __name__ == "__main__":
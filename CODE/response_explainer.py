@@ -1,10 +1,14 @@
 import sys
+import gzip
+import pickle
+import weakref
 import configparser
 import logging.config
 from copy import deepcopy
 
 import numpy as np
 import pandas as pd
+import scipy.sparse as sps
 import multiprocess as mp
 from sklearn.model_selection import KFold
 from sklearn.metrics import average_precision_score, roc_auc_score, r2_score
@@ -12,6 +16,8 @@ import xgboost as xgb
 import shap
 
 from modeling_utils import *
+from shap_store import save_shap_h5
+from feat_mtx_bundle import save_feat_mtx_bundle
 
 ## Intialize logger
 logging.config.fileConfig('logging.ini', disable_existing_loggers=False)
@@ -25,7 +31,11 @@ np.random.seed(RAND_NUM)
 MAX_RECURSION = int(config['DEFAULT']['max_recursion'])
 sys.setrecursionlimit(MAX_RECURSION)
 MAX_CV_FOLDS = int(config['DEFAULT']['max_cv_folds'])
+SHAP_WORKERS = int(config['DEFAULT']['shap_workers'])
+SHAP_CHUNK_SIZE = int(config['DEFAULT']['shap_chunk_size'])
+SHAP_BACKENDS = ['interventional', 'xgb_native']
 BG_GENE_NUM = 1000
+CHUNK_ROW_NUM = 50000
 
 
 class TFPRExplainer:
@@ -38,13 +48,44 @@ class TFPRExplainer:
         self.k_folds = min(MAX_CV_FOLDS, len(self.tfs))
         
         self.tg_pairs = [tf + ':' + gene for tf in self.tfs for gene in self.genes]
-        self.tf_X = np.vstack([tf_feat_mtx_dict[tf] for tf in self.tfs])
+        self.tg_pair_idx = {tg_pair: i for i, tg_pair in enumerate(self.tg_pairs)}
+        self.cv_folds = None
+        self.is_sparse = sps.issparse(nontf_feat_mtx)
+        if self.is_sparse:
+            self.tf_X = sps.vstack([tf_feat_mtx_dict[tf] for tf in self.tfs], format='csr')
+        else:
+            self.tf_X = np.vstack([tf_feat_mtx_dict[tf] for tf in self.tfs])
         self.nontf_X = nontf_feat_mtx
         self.y = np.hstack([label_df_dict[tf].values for tf in self.tfs])
+        ## Centering would densify sparse matrix, so only scale sparse features
+        self.std_method = 'scale' if self.is_sparse else 'zscore'
+        self.shared_specs = None
+
+    def share_inputs(self):
+        """Place feature matrices and labels in memory-mapped files once, so 
+        that worker processes receive only row indices and fold metadata.
+        """
+        if self.shared_specs is not None:
+            return self.shared_specs
+        shared_dir = create_shared_dir()
+        weakref.finalize(self, remove_shared_dir, shared_dir)
+
+        nontf_X, _ = standardize_feat_mtx(self.nontf_X, None, self.std_method)
+        self.shared_specs = {
+            'tf_X': create_shared_mtx(self.tf_X, shared_dir, 'tf_X'),
+            'nontf_X': create_shared_mtx(nontf_X, shared_dir, 'nontf_X'),
+            'y': create_shared_mtx(self.y, shared_dir, 'y'),
+            'n_genes': self.n_genes,
+            'std_method': self.std_method,
+            'dirpath': shared_dir}
+        return self.shared_specs
 
     def cross_validate(self):
         """Cross valdiate a classifier or regressor using multiprocessing.
         """
+        shared_specs = self.share_inputs()
+        self.cv_folds = []
+
         with mp.Pool(processes=self.k_folds) as pool:
             mp_results = {}
             tf_pseudo_X = np.empty((len(self.tfs), 0))
@@ -52,65 +93,145 @@ class TFPRExplainer:
             kfolds = KFold(n_splits=self.k_folds, shuffle=True, random_state=RAND_NUM)
 
             for k, (tf_tr_idx, tf_te_idx) in enumerate(kfolds.split(tf_pseudo_X)):
-                tr_idx = expand_tf2gene_index(tf_tr_idx, self.n_genes)
-                te_idx = expand_tf2gene_index(tf_te_idx, self.n_genes)
-                
-                y_tr, y_te = self.y[tr_idx], self.y[te_idx]
-                tf_X_tr, tf_X_te = self.tf_X[tr_idx], self.tf_X[te_idx]
-
-                tf_X_tr, tf_X_te = standardize_feat_mtx(tf_X_tr, tf_X_te, 'zscore')
-                nontf_X, _ = standardize_feat_mtx(self.nontf_X, None, 'zscore')
+                fold = FoldState(
+                    k, 
+                    expand_tf2gene_index(tf_tr_idx, self.n_genes),
+                    expand_tf2gene_index(tf_te_idx, self.n_genes))
+                self.cv_folds.append(fold)
 
                 mp_results[k] = pool.apply_async(
-                    train_and_predict,
+                    train_and_predict_shared,
                     args=(
-                        k, 
-                        (tf_X_tr, y_tr), 
-                        (tf_X_te, y_te),
-                        nontf_X, 
+                        fold, 
+                        shared_specs,
                         (self.tfs[tf_tr_idx], self.tfs[tf_te_idx]), 
                         self.genes))
 
             self.cv_results = compile_mp_results(mp_results)
 
-    def explain(self):
+        ## Keep fitted scaler and standardized test matrix for explanation
+        for fold, fold_update in zip(self.cv_folds, self.cv_results.pop('fold_states')):
+            fold.update(**fold_update)
+
+    def explain(self, n_workers=SHAP_WORKERS, chunk_size=SHAP_CHUNK_SIZE, 
+                shap_backend='interventional'):
         """Use SHAP values to features' contributions to predict the 
-        responsiveness of a gene.
+        responsiveness of a gene. Test rows of all folds are split into blocks
+        of `chunk_size` rows, which are explained by a pool of `n_workers`
+        processes (all cores if 0). Each block is written into a memory-mapped
+        SHAP matrix of its fold as soon as it is done.
+        Args:
+            n_workers       - Number of worker processes
+            chunk_size      - Number of test rows per block
+            shap_backend    - `interventional` for shap.TreeExplainer with 
+                            background genes, or `xgb_native` for XGBoost's 
+                            path-dependent contributions (no background)
         """
-        with mp.Pool(processes=self.k_folds) as pool:
-            mp_results = {}
+        if shap_backend not in SHAP_BACKENDS:
+            raise ValueError('Unknown SHAP backend: {}'.format(shap_backend))
+        shared_specs = self.share_inputs()
+        n_workers = n_workers if n_workers > 0 else mp.cpu_count()
 
-            for k, y_te in enumerate(self.cv_results['preds']):
-                n_tfs_te = len(y_te['tf'].unique())
-                n_tfs_tr = self.n_tfs - n_tfs_te
+        with mp.Pool(processes=n_workers) as pool:
+            mp_results = []
+            self.shap_vals = []
 
+            for k, y_te in enumerate(self.cv_results['preds']):
                 y_te['tf:gene'] = y_te['tf'] + ':' + y_te['gene']
                 te_tg_pairs = y_te['tf:gene'].values
-                te_idx = [self.tg_pairs.index(tg_pair) for tg_pair in te_tg_pairs]
-                
-                tr_idx = sorted(set(range(len(self.tg_pairs))) - set(te_idx))
-                logger.info('Explaining {} genes in fold {}'.format(len(te_idx), k))
-
-                tf_X_tr, tf_X_te = self.tf_X[tr_idx], self.tf_X[te_idx]
-
-                tf_X_tr, tf_X_te = standardize_feat_mtx(tf_X_tr, tf_X_te, 'zscore')
-                nontf_X, _ = standardize_feat_mtx(self.nontf_X, None, 'zscore')
-
-                X_tr = np.hstack([tf_X_tr, np.vstack([nontf_X for i in range(n_tfs_tr)])])
-                X_te = np.hstack([tf_X_te, np.vstack([nontf_X for i in range(n_tfs_te)])])
+                fold = self.get_fold_state(k, te_tg_pairs)
+                self.prepare_fold_state(fold)
+                logger.info('Explaining {} genes in fold {}'.format(len(fold.te_idx), k))
 
                 bg_idx = np.random.choice(
-                    range(X_tr.shape[0]), BG_GENE_NUM, replace=False)
-                mp_results[k] = pool.apply_async(
-                    calculate_tree_shap,
-                    args=(
-                        self.cv_results['models'][k], 
-                        X_te, te_tg_pairs, X_tr[bg_idx],))
-            
-            self.shap_vals = [mp_results[k].get() for k in sorted(mp_results.keys())]
-
-    def save(self, dirpath):
-        """Save output data.
+                    range(len(fold.tr_idx)), BG_GENE_NUM, replace=False)
+                fold_specs = self.share_fold_explainer(
+                    fold, self.cv_results['models'][k], bg_idx, shap_backend)
+                fold_specs['nthread'] = max(1, mp.cpu_count() // n_workers)
+
+                for start in range(0, len(fold.te_idx), chunk_size):
+                    stop = min(start + chunk_size, len(fold.te_idx))
+                    mp_results.append(pool.apply_async(
+                        calculate_tree_shap_chunk,
+                        args=(
+                            shared_specs, 
+                            fold_specs, 
+                            fold.te_idx[start:stop] % self.n_genes, 
+                            start, stop,)))
+                self.shap_vals.append((te_tg_pairs, fold_specs['shap']))
+
+            for i, mp_result in enumerate(mp_results):
+                mp_result.get()
+                logger.debug('Explained {}/{} blocks'.format(i + 1, len(mp_results)))
+
+        self.shap_vals = [
+            (tg_pairs, load_shared_mtx(spec)) for tg_pairs, spec in self.shap_vals]
+
+    def prepare_fold_state(self, fold):
+        """Fit the scaler and share the standardized test matrix of a fold, if
+        they were not kept by cross validation.
+        """
+        if fold.tf_X_te is not None:
+            return
+        shared_specs = self.share_inputs()
+        tf_scaler = fit_feat_scaler(self.tf_X[fold.tr_idx], self.std_method)
+        fold.update(
+            tf_scaler=tf_scaler,
+            tf_X_te=create_shared_mtx(
+                transform_feat_mtx(self.tf_X[fold.te_idx], tf_scaler), 
+                shared_specs['dirpath'], 'tf_X_te.{}'.format(fold.k)))
+
+    def share_fold_explainer(self, fold, model, bg_idx, shap_backend='interventional'):
+        """Share the model, background samples and output SHAP matrix of a fold
+        with the explanation workers.
+        """
+        shared_specs = self.share_inputs()
+        dirpath = shared_specs['dirpath']
+        n_feats = self.tf_X.shape[1] + self.nontf_X.shape[1]
+
+        model_filepath = '{}/model.{}.pkl'.format(dirpath, fold.k)
+        with open(model_filepath, 'wb') as f:
+            pickle.dump(model, f)
+        shap_filepath = '{}/shap.{}.npy'.format(dirpath, fold.k)
+        np.lib.format.open_memmap(
+            shap_filepath, mode='w+', dtype=np.float32, 
+            shape=(len(fold.te_idx), n_feats)).flush()
+
+        fold_specs = {
+            'k': fold.k,
+            'backend': shap_backend,
+            'model': model_filepath,
+            'X_bg': None,
+            'tf_X_te': fold.tf_X_te,
+            'shap': {'format': 'dense', 'filepath': shap_filepath}}
+
+        if shap_backend == 'interventional':
+            nontf_X = load_shared_mtx(shared_specs['nontf_X'])
+            bg_rows = fold.tr_idx[bg_idx]
+            X_bg = FactorizedDesignMatrix(
+                transform_feat_mtx(self.tf_X[bg_rows], fold.tf_scaler), 
+                nontf_X, bg_rows % self.n_genes)
+            fold_specs['X_bg'] = create_shared_mtx(
+                X_bg.to_matrix(), dirpath, 'X_bg.{}'.format(fold.k))
+        return fold_specs
+
+    def get_fold_state(self, k, te_tg_pairs):
+        """Get the state of fold k. Use the state recorded by cross validation,
+        or reconstruct the split from the test tf:gene pairs if cross validation
+        results were loaded from elsewhere.
+        """
+        if self.cv_folds is not None:
+            return self.cv_folds[k]
+        te_idx = np.array([self.tg_pair_idx[tg_pair] for tg_pair in te_tg_pairs], dtype=int)
+        tr_idx = np.setdiff1d(np.arange(len(self.tg_pairs)), te_idx)
+        return FoldState(k, tr_idx, te_idx)
+
+    def save(self, dirpath, export_shap_csv=False, feat_mtx_format='h5'):
+        """Save output data. SHAP values are saved as a float32 matrix in HDF5
+        (see shap_store.load_shap_h5), and optionally exported in long format
+        as gzipped CSV. Feature matrices and labels are saved as a compressed 
+        HDF5 bundle (see feat_mtx_bundle.load_feat_mtx_bundle), or as gzipped
+        CSV (npz if sparse) if `feat_mtx_format` is `csv`.
         """
         pd.concat(self.cv_results['preds']).to_csv(
             '{}/preds.csv.gz'.format(dirpath), 
@@ -128,40 +249,147 @@ class TFPRExplainer:
             '{}/tf_gene_pairs.csv.gz'.format(dirpath), np.array(self.tg_pairs),
             fmt='%s', delimiter=',')
     
-        np.savetxt(
-            '{}/feat_mtx_tf.csv.gz'.format(dirpath), self.tf_X,
-            fmt='%.8f', delimiter=',')
-        np.savetxt(
-            '{}/feat_mtx_nontf.csv.gz'.format(dirpath), self.nontf_X,
-            fmt='%.8f', delimiter=',')
-
-        # TODO
-        for k, df in enumerate(self.shap_vals):
-            df['cv'] = k
-            self.shap_vals[k] = df
-        pd.concat(self.shap_vals).to_csv(
-            '{}/feat_shap_wbg.csv.gz'.format(dirpath),
-            index=False, compression='gzip')
+        if feat_mtx_format == 'h5':
+            save_feat_mtx_bundle(
+                '{}/feat_mtx.h5'.format(dirpath), self.tf_X, self.nontf_X,
+                self.feats, self.tfs, self.genes, self.y)
+        elif self.is_sparse:
+            sps.save_npz('{}/feat_mtx_tf.npz'.format(dirpath), self.tf_X)
+            sps.save_npz('{}/feat_mtx_nontf.npz'.format(dirpath), self.nontf_X)
+        else:
+            np.savetxt(
+                '{}/feat_mtx_tf.csv.gz'.format(dirpath), self.tf_X,
+                fmt='%.8f', delimiter=',')
+            np.savetxt(
+                '{}/feat_mtx_nontf.csv.gz'.format(dirpath), self.nontf_X,
+                fmt='%.8f', delimiter=',')
+
+        save_shap_h5('{}/feat_shap_wbg.h5'.format(dirpath), self.shap_vals, self.n_genes)
+
+        if export_shap_csv:
+            ## Convert SHAP matrix of each fold to long format
+            with gzip.open('{}/feat_shap_wbg.csv.gz'.format(dirpath), 'wt') as f:
+                for k, (tg_pairs, shap_mtx) in enumerate(self.shap_vals):
+                    df = convert_shap_mtx_to_long(shap_mtx, tg_pairs)
+                    df['cv'] = k
+                    df.to_csv(f, index=False, header=(k == 0))
+
+
+class FoldState:
+    """State of a cross validation fold, i.e. the training and test row indices,
+    the scaler fitted on training rows, and the standardized TF-related test 
+    matrix (in shared memory). Explanation reuses it instead of refitting.
+    """
+    def __init__(self, k, tr_idx, te_idx, tf_scaler=None, tf_X_te=None):
+        self.k = k
+        self.tr_idx = tr_idx
+        self.te_idx = te_idx
+        self.tf_scaler = tf_scaler
+        self.tf_X_te = tf_X_te
+
+    def update(self, tf_scaler=None, tf_X_te=None):
+        self.tf_scaler = tf_scaler
+        self.tf_X_te = tf_X_te
+
+
+def load_shared_inputs(shared_specs):
+    """Load shared feature matrices and labels in a worker process.
+    """
+    return tuple(load_shared_mtx(shared_specs[x]) for x in ['tf_X', 'nontf_X', 'y'])
 
 
-def train_and_predict(k, D_tr, D_te, nontf_X, tfs, genes):
-    """Train classifier and predict gene responses. 
+def train_and_predict_shared(fold, shared_specs, tfs, genes):
+    """Wrapper of train_and_predict for shared inputs. Standardize the fold,
+    and return the fitted scaler and standardized test matrix as fold state.
+    """
+    tf_X, nontf_X, y = load_shared_inputs(shared_specs)
+    n_genes = shared_specs['n_genes']
+    tr_idx, te_idx = fold.tr_idx, fold.te_idx
+
+    tf_X_tr = tf_X[tr_idx]
+    tf_scaler = fit_feat_scaler(tf_X_tr, shared_specs['std_method'])
+    tf_X_tr = transform_feat_mtx(tf_X_tr, tf_scaler)
+    tf_X_te = transform_feat_mtx(tf_X[te_idx], tf_scaler)
+
+    X_tr = FactorizedDesignMatrix(tf_X_tr, nontf_X, tr_idx % n_genes)
+    X_te = FactorizedDesignMatrix(tf_X_te, nontf_X, te_idx % n_genes)
+    results = train_and_predict(fold.k, (X_tr, y[tr_idx]), (X_te, y[te_idx]), tfs, genes)
+
+    results['fold_states'] = {
+        'tf_scaler': tf_scaler,
+        'tf_X_te': create_shared_mtx(
+            tf_X_te, shared_specs['dirpath'], 'tf_X_te.{}'.format(fold.k))}
+    return results
+
+
+## Cache of fold explainers in a worker process, keyed by model filepath
+FOLD_EXPLAINER_CACHE = {}
+
+
+def load_fold_explainer(fold_specs):
+    """Load the SHAP explainer of a fold in a worker process. Keep only the 
+    latest fold, since blocks are scheduled fold by fold.
+    """
+    key = fold_specs['model']
+    if key not in FOLD_EXPLAINER_CACHE:
+        FOLD_EXPLAINER_CACHE.clear()
+        with open(fold_specs['model'], 'rb') as f:
+            model = pickle.load(f)
+        if fold_specs['backend'] == 'xgb_native':
+            booster = model.get_booster()
+            booster.set_param('nthread', fold_specs.get('nthread', 1))
+            FOLD_EXPLAINER_CACHE[key] = booster
+        else:
+            X_bg = convert_sparse_to_dense(load_shared_mtx(fold_specs['X_bg']))
+            FOLD_EXPLAINER_CACHE[key] = shap.TreeExplainer(model, X_bg)
+    return FOLD_EXPLAINER_CACHE[key]
+
+
+def calculate_tree_shap_chunk(shared_specs, fold_specs, gene_idx, start, stop):
+    """Calculate SHAP values for a block of test rows [start, stop) of a fold,
+    and write them into the shared SHAP matrix of the fold.
+    """
+    explainer = load_fold_explainer(fold_specs)
+    nontf_X = load_shared_mtx(shared_specs['nontf_X'])
+    tf_X_te = load_shared_mtx(fold_specs['tf_X_te'])
+
+    X = FactorizedDesignMatrix(tf_X_te[start:stop], nontf_X, gene_idx).to_matrix()
+    shap_mtx = np.load(fold_specs['shap']['filepath'], mmap_mode='r+')
+    if fold_specs['backend'] == 'xgb_native':
+        shap_mtx[start:stop] = calculate_xgb_native_shap(explainer, X)
+    else:
+        shap_mtx[start:stop] = explainer.shap_values(
+            convert_sparse_to_dense(X), approximate=False, check_additivity=False)
+    shap_mtx.flush()
+    return stop - start
+
+
+def calculate_xgb_native_shap(booster, X):
+    """Calculate exact path-dependent SHAP values using XGBoost's built-in
+    TreeSHAP. Sparse input keeps unstored entries as missing values, the same 
+    as in training. The last column (bias) is dropped to keep the layout of 
+    feature contributions.
+    """
+    contribs = booster.predict(xgb.DMatrix(X), pred_contribs=True)
+    return contribs[:, :-1]
+
+
+def train_and_predict(k, D_tr, D_te, tfs, genes):
+    """Train classifier and predict gene responses. The design matrices are 
+    given in factorized form. The training matrix is filled in row chunks into
+    one float32 buffer (or csr matrix) for the XGBoost DMatrix, which needs
+    all training rows at once, so training memory is that buffer plus the 
+    DMatrix. Prediction runs in row chunks.
     """
     logger.info('Cross validating fold {}'.format(k))
 
-    tf_X_tr, y_tr = D_tr
-    tf_X_te, y_te = D_te
+    X_tr, y_tr = D_tr
+    X_te, y_te = D_te
     tfs_tr, tfs_te = tfs
 
-    X_tr = np.hstack([tf_X_tr, np.vstack([nontf_X for i in range(len(tfs_tr))])])
-    X_te = np.hstack([tf_X_te, np.vstack([nontf_X for i in range(len(tfs_te))])])
-
     ## Train classifier and test
-    model = train_classifier(X_tr, y_tr)
-
-    y_pred = pd.DataFrame(
-        data=model.predict_proba(X_te), 
-        columns=model.classes_)[1].values
+    model = train_classifier(X_tr.to_matrix(np.float32), y_tr)
+    y_pred = predict_proba_in_chunks(model, X_te)
 
     ## Calculate AUC for each TF
     stats_df = pd.DataFrame()
@@ -202,6 +430,17 @@ def train_classifier(X, y):
     return model
 
 
+def predict_proba_in_chunks(model, X, chunk_size=CHUNK_ROW_NUM):
+    """Predict the probability of being responsive for factorized design matrix
+    in row chunks.
+    """
+    pos_idx = list(model.classes_).index(1)
+    y_pred = np.empty(X.shape[0])
+    for start, stop, X_chunk in X.iter_chunks(chunk_size):
+        y_pred[start:stop] = model.predict_proba(X_chunk)[:, pos_idx]
+    return y_pred
+
+
 def train_regressor(X, y):
     """Train a XGBoost regressor.
     """
@@ -217,18 +456,40 @@ def train_regressor(X, y):
     return model
 
 
-def calculate_tree_shap(model, X, genes, X_bg):
-    """Calcualte SHAP values for tree-based model.
+def calculate_tree_shap(model, X, genes, X_bg=None, chunk_size=None, 
+                        shap_backend='interventional'):
+    """Calcualte SHAP values for tree-based model. If chunk size is given, or 
+    X is a factorized design matrix, explain X in blocks of rows to bound memory.
+    Background samples X_bg are only used by the `interventional` backend.
     """
     n_genes, n_feats = X.shape
-    
+    chunk_size = chunk_size if chunk_size is not None else CHUNK_ROW_NUM
+    if not isinstance(X, FactorizedDesignMatrix):
+        X = FactorizedDesignMatrix(X, np.empty((n_genes, 0)), np.arange(n_genes))
+
     ## Calculate SHAP values
-    explainer = shap.TreeExplainer(model, X_bg)
-    shap_mtx = explainer.shap_values(X, approximate=False, check_additivity=False)
-    
-    ## Convert wide to long format
+    if shap_backend == 'xgb_native':
+        booster = model.get_booster()
+        explain_chunk = lambda X_chunk: calculate_xgb_native_shap(booster, X_chunk)
+    else:
+        ## Interventional SHAP requires dense input; keep sparse zeros as missing
+        explainer = shap.TreeExplainer(model, convert_sparse_to_dense(X_bg))
+        explain_chunk = lambda X_chunk: explainer.shap_values(
+            convert_sparse_to_dense(X_chunk), 
+            approximate=False, check_additivity=False)
+
+    shap_mtx = np.empty((n_genes, n_feats))
+    for start, stop, X_chunk in X.iter_chunks(chunk_size):
+        shap_mtx[start:stop] = explain_chunk(X_chunk)
+    return convert_shap_mtx_to_long(shap_mtx, genes)
+
+
+def convert_shap_mtx_to_long(shap_mtx, genes):
+    """Convert SHAP matrix (gene x feature) from wide to long format.
+    """
+    n_feats = shap_mtx.shape[1]
     shap_df = pd.DataFrame(
-        data=shap_mtx,
+        data=np.asarray(shap_mtx),
         index=genes,
         columns=['feat' + str(i) for i in range(n_feats)])
     shap_df.index.name = 'gene'
@@ -238,7 +499,7 @@ def calculate_tree_shap(model, X, genes, X_bg):
 
 
 def expand_tf2gene_index(t, n):
-    g = []
-    for i in t:
-        g += list(range(i * n, (i + 1) * n))
-    return g
+    """Expand TF indices into row indices of the (TF, gene) feature matrix.
+    """
+    t = np.asarray(t, dtype=int)
+    return (t.reshape(-1, 1) * n + np.arange(n, dtype=int)).ravel()
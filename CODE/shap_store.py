@@ -0,0 +1,83 @@
+import numpy as np
+import h5py
+
+
+## Largest number of values per HDF5 chunk (64 MB of float32)
+MAX_CHUNK_VALUES = 2 ** 24
+
+
+def save_shap_h5(filepath, shap_vals, n_genes):
+    """Save SHAP matrices of all folds as a single float32 matrix in HDF5. Rows
+    of a fold are stacked after the previous fold, and each TF's block of
+    `n_genes` rows is stored as one chunk.
+    Args:
+        filepath    - h5 filepath
+        shap_vals   - List of tuples (tf:gene labels, SHAP matrix), one per fold
+        n_genes     - Number of genes per TF
+    """
+    n_rows = sum([len(x) for x, _ in shap_vals])
+    n_feats = shap_vals[0][1].shape[1] if len(shap_vals) > 0 else 0
+    chunk_rows = max(1, min(n_genes, MAX_CHUNK_VALUES // max(n_feats, 1)))
+
+    with h5py.File(filepath, 'w') as f:
+        f.attrs['n_genes'] = n_genes
+        ## Empty datasets cannot be chunked
+        chunk_kwargs = {}
+        if n_rows > 0 and n_feats > 0:
+            chunk_kwargs = {
+                'chunks': (min(chunk_rows, n_rows), n_feats),
+                'compression': 'lzf', 'shuffle': True}
+        dset = f.create_dataset(
+            'shap', shape=(n_rows, n_feats), dtype=np.float32, **chunk_kwargs)
+        fold_offsets = [0]
+        for tg_pairs, shap_mtx in shap_vals:
+            offset = fold_offsets[-1]
+            for start in range(0, len(tg_pairs), chunk_rows):
+                stop = min(start + chunk_rows, len(tg_pairs))
+                dset[offset + start:offset + stop] = np.asarray(
+                    shap_mtx[start:stop], dtype=np.float32)
+            fold_offsets.append(offset + len(tg_pairs))
+
+        f.create_dataset(
+            'tf_gene', data=np.array(
+                [x for tg_pairs, _ in shap_vals for x in tg_pairs], dtype='S'))
+        f.create_dataset(
+            'cv', data=np.repeat(
+                np.arange(len(shap_vals)), np.diff(fold_offsets)).astype(np.int32))
+        f.create_dataset('fold_offsets', data=np.array(fold_offsets, dtype=np.int64))
+        f.create_dataset('feat_idx', data=np.arange(n_feats, dtype=np.int32))
+
+
+def load_shap_h5(filepath, tfs=None):
+    """Load SHAP matrix saved by save_shap_h5. If TFs are given, only read the
+    row blocks of these TFs.
+    Args:
+        filepath    - h5 filepath
+        tfs         - List of TFs to be loaded (all TFs if None)
+    Returns:
+        Tuple of SHAP matrix (tf:gene x feature), tf:gene labels, CV fold of
+        each row, and feature (column) indices
+    """
+    with h5py.File(filepath, 'r') as f:
+        tg_pairs = f['tf_gene'][:].astype(str)
+        cvs = f['cv'][:]
+        feat_idx = f['feat_idx'][:]
+        if tfs is None:
+            return f['shap'][:], tg_pairs, cvs, feat_idx
+
+        row_tfs = np.array([x.split(':')[0] for x in tg_pairs])
+        mask = np.isin(row_tfs, tfs)
+        shap_mtx = np.empty((mask.sum(), len(feat_idx)), dtype=np.float32)
+        i = 0
+        for start, stop in find_true_runs(mask):
+            shap_mtx[i:i + stop - start] = f['shap'][start:stop]
+            i += stop - start
+    return shap_mtx, tg_pairs[mask], cvs[mask], feat_idx
+
+
+def find_true_runs(mask):
+    """Find [start, stop) ranges of consecutive True values in a boolean array.
+    """
+    padded = np.concatenate([[False], mask, [False]]).astype(np.int8)
+    edges = np.flatnonzero(np.diff(padded))
+    return zip(edges[::2], edges[1::2])
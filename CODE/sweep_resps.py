@@ -0,0 +1,217 @@
+import sys
+import os.path
+import argparse
+import configparser
+import warnings
+import logging.config
+from multiprocess.connection import wait
+
+from modeling_utils import *
+from response_explainer import TFPRExplainer
+import explain_yeast_resps
+import explain_human_resps
+
+
+warnings.filterwarnings("ignore")
+
+## Initialize logger
+logging.config.fileConfig('logging.ini', disable_existing_loggers=False)
+logger = logging.getLogger(__name__)
+
+## Load default configuration
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+RAND_NUM = int(config['DEFAULT']['rand_num'])
+SHAP_WORKERS = int(config['DEFAULT']['shap_workers'])
+FEAT_MTX_WORKERS = int(config['DEFAULT']['feat_mtx_workers'])
+FEAT_MTX_MEM_GB = float(config['DEFAULT']['feat_mtx_mem_gb'])
+
+## Marker file written into the output directory of a completed group
+COMPLETED_MARKER = 'SWEEP_COMPLETED'
+
+GENOME_MODULES = {'yeast': explain_yeast_resps, 'human': explain_human_resps}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Explain responses of TF groups sharing TF-unrelated features.')
+    parser.add_argument(
+        '-g', '--genome', required=True, choices=sorted(GENOME_MODULES.keys()),
+        help='Genome, which defines the regulatory DNA and label format.')
+    parser.add_argument(
+        '-m', '--manifest', required=True,
+        help='Tab-delimited manifest, one TF group per line: output directory, then TFs delimited by single space.')
+    parser.add_argument(
+        '-f', '--feature_types', required=True, nargs='*',
+        help='Feature type(s) to be included in feature matrix (delimited by single space).')
+    parser.add_argument(
+        '-x', '--feature_h5', required=True,
+        help='h5 file for input features.')
+    parser.add_argument(
+        '-y', '--response_label', required=True,
+        help='csv file for perturbation response label.')
+    parser.add_argument(
+        '-p', '--n_workers', type=int, default=1,
+        help='Number of TF groups processed concurrently.')
+    parser.add_argument(
+        '--sparse', action='store_true',
+        help='Keep feature matrices sparse (features are scaled without centering).')
+    parser.add_argument(
+        '--shap_backend', default='interventional',
+        choices=['interventional', 'xgb_native'],
+        help='SHAP backend: interventional TreeSHAP with background genes (default), or XGBoost native path-dependent contributions.')
+    parser.add_argument(
+        '--shap_csv', action='store_true',
+        help='Also export SHAP values in long format as gzipped csv (slow for large runs).')
+    parser.add_argument(
+        '--feat_mtx_format', default='h5', choices=['h5', 'csv'],
+        help='Output format of feature matrices: compressed HDF5 bundle (default), or gzipped csv.')
+    parser.add_argument(
+        '-c', '--cache_dir',
+        help='Directory path for caching feature matrices across runs (disabled if not given).')
+    parsed = parser.parse_args(argv[1:])
+    return parsed
+
+
+def load_manifest(filepath):
+    """Load TF groups from manifest.
+    Returns:
+        List of tuples (output directory, list of TFs)
+    """
+    groups = []
+    with open(filepath) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            if len(fields) != 2 or len(fields[1].split()) == 0:
+                logger.error('Invalid manifest line: {}. ==> Aborted <=='.format(line))
+                sys.exit(1)
+            groups.append((fields[0], fields[1].split()))
+    return groups
+
+
+def is_group_completed(output_dir, tfs):
+    """Check if a group has been completed with the same TFs.
+    """
+    filepath = '{}/{}'.format(output_dir, COMPLETED_MARKER)
+    if not os.path.exists(filepath):
+        return False
+    with open(filepath) as f:
+        return f.read().split() == tfs
+
+
+def run_group(args, output_dir, tfs, shared_dict, worker_dict):
+    """Cross validate and explain the responses of a TF group, and mark the
+    group as completed.
+    Args:
+        worker_dict     - Share of each concurrent group in the numbers of SHAP
+                        and feature workers, and the feature memory budget
+    """
+    np.random.seed(RAND_NUM)
+    genome_module = GENOME_MODULES[args.genome]
+    filepath_dict = {
+        'feat_h5': args.feature_h5,
+        'resp_label': args.response_label,
+        'output_dir': output_dir,
+        'feat_cache': args.cache_dir}
+    feat_info_dict = genome_module.create_feat_info_dict(tfs, args.feature_types, args.sparse)
+
+    logger.info('==> Constructing TF-related features for {} <=='.format(output_dir))
+    tf_feat_mtx_dict, nontf_feat_mtx, features, label_df_dict = construct_group_input(
+        filepath_dict, feat_info_dict, shared_dict, args.genome == 'yeast',
+        n_workers=worker_dict['feat_mtx_workers'], mem_gb=worker_dict['feat_mtx_mem_gb'])
+
+    tfpr_explainer = TFPRExplainer(tf_feat_mtx_dict, nontf_feat_mtx, features, label_df_dict)
+    logger.info('==> Cross validating response prediction model for {} <=='.format(output_dir))
+    tfpr_explainer.cross_validate()
+    logger.info('==> Analyzing feature contributions for {} <=='.format(output_dir))
+    tfpr_explainer.explain(n_workers=worker_dict['shap_workers'], shap_backend=args.shap_backend)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    tfpr_explainer.save(output_dir, export_shap_csv=args.shap_csv,
+        feat_mtx_format=args.feat_mtx_format)
+    with open('{}/{}'.format(output_dir, COMPLETED_MARKER), 'w') as f:
+        f.write(' '.join(tfs) + '\n')
+
+
+def run_groups(args, groups, shared_dict):
+    """Run TF groups in at most `n_workers` concurrent processes. Processes are
+    not daemonic, so that each group can use its own worker pools.
+    Returns:
+        List of output directories of failed groups
+    """
+    n_workers = max(1, args.n_workers)
+    ## Split workers and memory budget among concurrent groups
+    n_shap_workers = SHAP_WORKERS if SHAP_WORKERS > 0 else mp.cpu_count()
+    n_feat_workers = FEAT_MTX_WORKERS if FEAT_MTX_WORKERS > 0 else mp.cpu_count()
+    worker_dict = {
+        'shap_workers': max(1, n_shap_workers // n_workers),
+        'feat_mtx_workers': max(1, n_feat_workers // n_workers),
+        'feat_mtx_mem_gb': FEAT_MTX_MEM_GB / n_workers}
+
+    pending = list(groups)
+    running = {}
+    failed = []
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < n_workers:
+            output_dir, tfs = pending.pop(0)
+            mp_job = mp.Process(
+                target=run_group,
+                args=(args, output_dir, tfs, shared_dict, worker_dict))
+            mp_job.start()
+            running[mp_job.sentinel] = (output_dir, mp_job)
+
+        for sentinel in wait(list(running.keys())):
+            output_dir, mp_job = running.pop(sentinel)
+            mp_job.join()
+            if mp_job.exitcode != 0:
+                logger.error('TF group {} failed with exit code {}'.format(output_dir, mp_job.exitcode))
+                failed.append(output_dir)
+            else:
+                logger.info('TF group {} completed'.format(output_dir))
+    return failed
+
+
+def main(argv):
+    ## Parse arguments
+    args = parse_args(argv)
+    logger.info('Input arguments: {}'.format(args))
+    genome_module = GENOME_MODULES[args.genome]
+
+    ## Skip groups completed by previous runs
+    groups = []
+    for output_dir, tfs in load_manifest(args.manifest):
+        if is_group_completed(output_dir, tfs):
+            logger.info('Skipped completed TF group {}'.format(output_dir))
+        else:
+            groups.append((output_dir, tfs))
+    if len(groups) == 0:
+        logger.info('==> Completed <==')
+        return
+
+    ## Construct inputs shared by all groups
+    logger.info('==> Constructing labels and TF-unrelated features <==')
+    filepath_dict = {
+        'feat_h5': args.feature_h5,
+        'resp_label': args.response_label,
+        'feat_cache': args.cache_dir}
+    all_tfs = sorted(set([tf for _, tfs in groups for tf in tfs]))
+    feat_info_dict = genome_module.create_feat_info_dict(all_tfs, args.feature_types, args.sparse)
+    shared_dict = construct_shared_input(filepath_dict, feat_info_dict, args.genome == 'yeast')
+    shared_dict['labels_dict'] = genome_module.binarize_label_dict(shared_dict['labels_dict'])
+
+    ## Run groups, which inherit the shared inputs
+    logger.info('==> Running {} TF groups <=='.format(len(groups)))
+    failed = run_groups(args, groups, shared_dict)
+    if len(failed) > 0:
+        logger.error('{} TF groups failed: {}. ==> Aborted <=='.format(len(failed), ', '.join(failed)))
+        sys.exit(1)
+
+    logger.info('==> Completed <==')
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -5,6 +5,8 @@ from glob import glob
 import scipy.stats as ss
 from sklearn.metrics import r2_score, roc_auc_score, average_precision_score
 
+from shap_store import load_shap_h5
+
 
 COLORS = {
     'orange': '#f0593e', 
@@ -111,31 +113,20 @@ def get_feature_indices(df, organism):
 
 
 def calculate_resp_and_unresp_signed_shap_sum(data_dir, tfs, organism, sum_over_type='tf'):
-    # TODO: update shap csv header
     print('Loading feature data ...')
-    shap_df = pd.read_csv('{}/feat_shap_wbg.csv.gz'.format(data_dir))
-    shap_df = shap_df.rename(columns={'gene': 'tf:gene', 'feat': 'shap'})
-    shap_df['tf'] = shap_df['tf:gene'].apply(lambda x: x.split(':')[0])
-    shap_df = shap_df[shap_df['tf'].isin(tfs)]
-
     feats_df = pd.read_csv('{}/feats.csv.gz'.format(data_dir), names=['feat_type', 'feat_name', 'start', 'end'])
 
     preds_df = pd.read_csv('{}/preds.csv.gz'.format(data_dir))
     preds_df = preds_df[preds_df['tf'].isin(tfs)]
 
     feat_idx_df = get_feature_indices(feats_df, organism)
-    
-    ## Parse out shap+ and shap- values
-    print('Parsing signed shap values ...')
-    shap_df = shap_df.merge(preds_df[['tf:gene', 'label', 'gene']], how='left', on='tf:gene')
-    shap_df['shap+'] = shap_df['shap'].apply(lambda x: x if x > 0 else 0)
-    shap_df['shap-'] = shap_df['shap'].apply(lambda x: x if x < 0 else 0)
 
     ## Sum across reg region for each feature and each tf:gene, and then take 
     ## the mean among responsive targets and repeat for non-responsive targets.
-    print('Summing shap ...')
-    shap_df = shap_df.merge(feat_idx_df[['feat_type_name', 'feat_idx']], on='feat_idx')
-    sum_shap = shap_df.groupby(['tf', 'gene', 'label', 'feat_type_name'])[['shap+', 'shap-']].sum().reset_index()
+    if os.path.exists('{}/feat_shap_wbg.h5'.format(data_dir)):
+        sum_shap = sum_signed_shap_h5(data_dir, tfs, preds_df, feat_idx_df)
+    else:
+        sum_shap = sum_signed_shap_csv(data_dir, tfs, preds_df, feat_idx_df)
     sum_shap = sum_shap.groupby([sum_over_type, 'label', 'feat_type_name'])[['shap+', 'shap-']].mean().reset_index()
     sum_shap['label_name'] = ['Responsive' if x == 1 else 'Non-responsive' for x in sum_shap['label']]
     sum_shap['label_name'] = pd.Categorical(
@@ -151,6 +142,53 @@ def calculate_resp_and_unresp_signed_shap_sum(data_dir, tfs, organism, sum_over_
     return sum_signed_shap
 
 
+def sum_signed_shap_h5(data_dir, tfs, preds_df, feat_idx_df):
+    """Sum positive and negative SHAP values over the columns of each feature 
+    type for each tf:gene, using the HDF5 SHAP matrix.
+    """
+    print('Summing signed shap ...')
+    shap_mtx, tg_pairs, _, feat_idx = load_shap_h5('{}/feat_shap_wbg.h5'.format(data_dir), tfs)
+
+    ## Indicator matrix (feature x feature type) for summing columns by type
+    feat_type_names = feat_idx_df['feat_type_name'].unique()
+    type_codes = pd.Categorical(feat_idx_df['feat_type_name'], categories=feat_type_names).codes
+    type_mtx = np.zeros((len(feat_idx), len(feat_type_names)))
+    type_mtx[feat_idx_df['feat_idx'].astype(int).values, type_codes] = 1
+
+    shap_pos = np.clip(shap_mtx, 0, None).dot(type_mtx)
+    shap_neg = np.clip(shap_mtx, None, 0).dot(type_mtx)
+    sum_shap = pd.DataFrame({
+        'tf:gene': np.repeat(tg_pairs, len(feat_type_names)),
+        'feat_type_name': np.tile(feat_type_names, len(tg_pairs)),
+        'shap+': shap_pos.ravel(),
+        'shap-': shap_neg.ravel()})
+    sum_shap['tf'] = [x.split(':')[0] for x in sum_shap['tf:gene']]
+    sum_shap = sum_shap.merge(preds_df[['tf:gene', 'label', 'gene']], how='left', on='tf:gene')
+    return sum_shap[['tf', 'gene', 'label', 'feat_type_name', 'shap+', 'shap-']]
+
+
+def sum_signed_shap_csv(data_dir, tfs, preds_df, feat_idx_df):
+    """Sum positive and negative SHAP values over the columns of each feature 
+    type for each tf:gene, using the long-format SHAP csv.
+    """
+    ## The csv keeps the column names of convert_shap_mtx_to_long, where `gene`
+    ## is the tf:gene pair and `feat` is the SHAP value
+    shap_df = pd.read_csv('{}/feat_shap_wbg.csv.gz'.format(data_dir))
+    shap_df = shap_df.rename(columns={'gene': 'tf:gene', 'feat': 'shap'})
+    shap_df['tf'] = shap_df['tf:gene'].apply(lambda x: x.split(':')[0])
+    shap_df = shap_df[shap_df['tf'].isin(tfs)]
+
+    ## Parse out shap+ and shap- values
+    print('Parsing signed shap values ...')
+    shap_df = shap_df.merge(preds_df[['tf:gene', 'label', 'gene']], how='left', on='tf:gene')
+    shap_df['shap+'] = shap_df['shap'].apply(lambda x: x if x > 0 else 0)
+    shap_df['shap-'] = shap_df['shap'].apply(lambda x: x if x < 0 else 0)
+
+    print('Summing shap ...')
+    shap_df = shap_df.merge(feat_idx_df[['feat_type_name', 'feat_idx']], on='feat_idx')
+    return shap_df.groupby(['tf', 'gene', 'label', 'feat_type_name'])[['shap+', 'shap-']].sum().reset_index()
+
+
 def get_best_yeast_model(data_dirs, tf_name):
     tf1_dir = '{}/{}'.format(data_dirs[0], tf_name)
     tf2_dir = '{}/{}'.format(data_dirs[1], tf_name)
@@ -36,13 +36,13 @@ def parse_args(argv):
 	return parsed
 
 
-def find_significant_IGRs(outputpath, experiment_gnashy_filename, background_gnashy_filename, orfPromoter_filename):
-	#read in promoter regions and populate columns
-	IGR_frame = readin_promoters(orfPromoter_filename)
+def find_significant_IGRs(outputpath, experiment_gnashy_filename, background_hops, promoter_frame):
+	#copy the promoter regions read in once for all experiments
+	IGR_frame = promoter_frame.copy()
 
-	#read in background and experiment hops gnashy files
+	#read in experiment hops gnashy file (background is read in once)
 	#and populate expected and observed hops
-	[IGR_frame,bg_hops,exp_hops] = readin_hops(IGR_frame,background_gnashy_filename,experiment_gnashy_filename)
+	[IGR_frame,bg_hops,exp_hops] = readin_hops(IGR_frame,background_hops,experiment_gnashy_filename)
 	
 	#read in orf table and populate common names
 	# IGR_frame = populate_common_names(IGR_frame,orfcoding_filename)
@@ -88,32 +88,47 @@ def readin_promoters(filename):
 	return IGR_frame
 
 
-def readin_hops(IGR_frame,background_gnashy_filename,experiment_gnashy_filename):
-	## read in the 3-column background and experiment gnashy data
-	background_frame = pd.read_csv(
-		background_gnashy_filename, delimiter="\t", header=None, usecols=[0, 1, 4])
-	background_frame.columns = ['Chr','Pos','Reads']
-	bg_hops = len(background_frame)
-	experiment_frame = pd.read_csv(
-		experiment_gnashy_filename, delimiter="\t", header=None, usecols=[0, 1, 4])
-	experiment_frame.columns = ['Chr','Pos','Reads']
-	exp_hops = len(experiment_frame)
-	## force chromosome in gnashy files to be string
-	background_frame["Chr"] = background_frame["Chr"].astype("|S10")
-	experiment_frame["Chr"] = experiment_frame["Chr"].astype("|S10")
-	## iter through each row and fill the dataframe
-	for indexvar in IGR_frame.index:
-		pos = [IGR_frame.ix[indexvar,"Start"], IGR_frame.ix[indexvar,"Stop"]]
-		IGR_frame.ix[indexvar,"Background Hops"] = len(background_frame[(background_frame["Chr"]==IGR_frame.ix[indexvar,"Chr"]) & (background_frame["Pos"] <= max(pos)) &(background_frame["Pos"] >= min(pos))])
-		IGR_frame.ix[indexvar,"Experiment Hops"] = len(experiment_frame[(experiment_frame["Chr"]==IGR_frame.ix[indexvar,"Chr"]) & (experiment_frame["Pos"] <= max(pos)) &(experiment_frame["Pos"] >= min(pos))])
-		IGR_frame.ix[indexvar,"Background TPH"] = float(IGR_frame.ix[indexvar,"Background Hops"])/float(bg_hops) *100000
-		IGR_frame.ix[indexvar,"Experiment TPH"] = float(IGR_frame.ix[indexvar,"Experiment Hops"])/float(exp_hops) *100000
-		IGR_frame.ix[indexvar,"Experiment TPH BS"] = IGR_frame.ix[indexvar,"Experiment TPH"] - IGR_frame.ix[indexvar,"Background TPH"]
-		if IGR_frame.ix[indexvar,"Experiment TPH BS"] < 0:
-			IGR_frame.ix[indexvar,"Experiment TPH BS"] = 0
+def readin_hops(IGR_frame,background_hops,experiment_gnashy_filename):
+	## background hops are parsed once by readin_gnashy
+	bg_pos_dict, bg_hops = background_hops
+	exp_pos_dict, exp_hops = readin_gnashy(experiment_gnashy_filename)
+	## count hops within each promoter, and normalize to transpositions per 100k hops
+	IGR_frame["Background Hops"] = count_hops(IGR_frame, bg_pos_dict)
+	IGR_frame["Experiment Hops"] = count_hops(IGR_frame, exp_pos_dict)
+	IGR_frame["Background TPH"] = IGR_frame["Background Hops"] / float(bg_hops) * 100000
+	IGR_frame["Experiment TPH"] = IGR_frame["Experiment Hops"] / float(exp_hops) * 100000
+	IGR_frame["Experiment TPH BS"] = np.maximum(IGR_frame["Experiment TPH"] - IGR_frame["Background TPH"], 0)
 	return IGR_frame,bg_hops,exp_hops
 
 
+def readin_gnashy(gnashy_filename):
+	## read in the 3-column gnashy data
+	hop_frame = pd.read_csv(
+		gnashy_filename, delimiter="\t", header=None, usecols=[0, 1, 4])
+	hop_frame.columns = ['Chr','Pos','Reads']
+	## force chromosome in gnashy files to be string
+	hop_chrs = hop_frame["Chr"].astype("|S10").astype(str).values
+	hop_pos = hop_frame["Pos"].values
+	## sort hop positions per chromosome
+	pos_dict = {}
+	for chrom in np.unique(hop_chrs):
+		pos_dict[chrom] = np.sort(hop_pos[hop_chrs == chrom])
+	return pos_dict, len(hop_frame)
+
+
+def count_hops(IGR_frame, pos_dict):
+	## count hops within [start, stop] (inclusive) of each promoter by binary search
+	IGR_chrs = IGR_frame["Chr"].astype(str).values
+	lows = np.minimum(IGR_frame["Start"].values, IGR_frame["Stop"].values)
+	highs = np.maximum(IGR_frame["Start"].values, IGR_frame["Stop"].values)
+	hop_counts = np.zeros(len(IGR_frame), dtype=int)
+	for chrom, pos in pos_dict.items():
+		is_chrom = IGR_chrs == chrom
+		hop_counts[is_chrom] = np.searchsorted(pos, highs[is_chrom], side='right') - \
+			np.searchsorted(pos, lows[is_chrom], side='left')
+	return hop_counts
+
+
 def populate_common_names(IGR_frame,orfcoding_filename):
 	orf_dict = {}
 	for x in Bio.SeqIO.parse(orfcoding_filename,"fasta"):
@@ -126,14 +141,14 @@ def populate_common_names(IGR_frame,orfcoding_filename):
 			if matchobj:
 				orf_dict[y_name] = matchobj.group(0)
 	for idx,row in IGR_frame.iterrows():
-		if IGR_frame.ix[idx,"Left Feature"] in orf_dict:
-			IGR_frame.ix[idx,"Left Common Name"] = orf_dict[row["Left Feature"]]
+		if IGR_frame.loc[idx,"Left Feature"] in orf_dict:
+			IGR_frame.loc[idx,"Left Common Name"] = orf_dict[row["Left Feature"]]
 		else:
-			IGR_frame.ix[idx,"Left Common Name"] = row["Left Feature"]
-		if IGR_frame.ix[idx,"Right Feature"] in orf_dict:
-			IGR_frame.ix[idx,"Right Common Name"] = orf_dict[row["Right Feature"]]
+			IGR_frame.loc[idx,"Left Common Name"] = row["Left Feature"]
+		if IGR_frame.loc[idx,"Right Feature"] in orf_dict:
+			IGR_frame.loc[idx,"Right Common Name"] = orf_dict[row["Right Feature"]]
 		else:
-			IGR_frame.ix[idx,"Right Common Name"] = row["Right Feature"]
+			IGR_frame.loc[idx,"Right Common Name"] = row["Right Feature"]
 	return IGR_frame
 
 
@@ -144,17 +159,19 @@ def compute_cumulative_hypergeometric(IGR_frame,bg_hops,exp_hops):
 	#M is total number of balls (total number of hops)
 	#n is total number of white balls (total number of expeirment hops)
 	#N is the number of balls drawn (total hops at a locus)
-	for idx,row in IGR_frame.iterrows():
-		IGR_frame.ix[idx,"CHG pvalue"] = 1-scistat.hypergeom.cdf(IGR_frame.ix[idx,"Experiment Hops"]-1,(bg_hops + exp_hops),exp_hops,(IGR_frame.ix[idx,"Experiment Hops"]+IGR_frame.ix[idx,"Background Hops"]))
+	IGR_frame["CHG pvalue"] = scistat.hypergeom.sf(
+		IGR_frame["Experiment Hops"].values-1,(bg_hops + exp_hops),exp_hops,
+		(IGR_frame["Experiment Hops"].values+IGR_frame["Background Hops"].values))
 	return IGR_frame
 
 
 def compute_cumulative_poisson(IGR_frame,bg_hops,exp_hops):
 	#usage
-	#scistat.poisson.cdf(x,mu)
+	#scistat.poisson.sf(x,mu), i.e. 1 - scistat.poisson.cdf(x,mu)
 	pseudocount = 0.2
-	for idx,row in IGR_frame.iterrows():
-		IGR_frame.ix[idx,"Poisson pvalue"] = 1-scistat.poisson.cdf((IGR_frame.ix[idx,"Experiment Hops"]+pseudocount),(IGR_frame.ix[idx,"Background Hops"] * (float(exp_hops)/float(bg_hops)) + pseudocount))
+	IGR_frame["Poisson pvalue"] = scistat.poisson.sf(
+		IGR_frame["Experiment Hops"].values + pseudocount,
+		IGR_frame["Background Hops"].values * (float(exp_hops)/float(bg_hops)) + pseudocount)
 	return IGR_frame
 
 
@@ -163,10 +180,13 @@ def main(argv):
 	parsed.gnashypath += "/" if not parsed.gnashypath.endswith("/") else ""
 	parsed.outputpath += "/" if not parsed.outputpath.endswith("/") else ""
 	
+	## read in promoters and background hops once for all experiments
+	promoter_frame = readin_promoters(parsed.promfile)
+	background_hops = readin_gnashy(parsed.bgfile)
 	for gnashyfile in glob.glob(parsed.gnashypath+"*.gnashy"):
 		if os.path.normpath(parsed.bgfile) != os.path.normpath(gnashyfile): 
 			print("... working on", gnashyfile)
-			find_significant_IGRs(parsed.outputpath, gnashyfile, parsed.bgfile, parsed.promfile)
+			find_significant_IGRs(parsed.outputpath, gnashyfile, background_hops, promoter_frame)
 
 
 if __name__ == '__main__': 
@@ -0,0 +1,7 @@
+import os
+import sys
+
+## Modules in CODE read logging.ini and config.ini from the repository root
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'CODE'))
@@ -0,0 +1,57 @@
+import shutil
+import numpy as np
+import pandas as pd
+import pytest
+
+pybedtools = pytest.importorskip('pybedtools')
+import data_preproc_utils as dpu
+
+
+BED_COLS = ['chrom', 'start', 'end', 'name', 'score', 'strand']
+FEAT_COLS = ['gene_idx', 'rel_start', 'rel_end', 'peak_score']
+
+
+def write_bed(df, filepath):
+    df.to_csv(filepath, sep='\t', header=False, index=False)
+    return str(filepath)
+
+
+@pytest.mark.skipif(shutil.which('bedtools') is None, reason='bedtools not installed')
+def test_peak_track_backends_with_duplicated_gene(tmp_path):
+    ## gA has two TSS rows, e.g. alternative TSSs
+    gene_df = pd.DataFrame(
+        [['chr1', 1000, 1001, 'gA', 0, '+'], ['chr1', 1200, 1201, 'gA', 0, '+'],
+        ['chr1', 3000, 3001, 'gB', 0, '-'], ['chr1', 2000, 2001, 'gC', 0, '+']],
+        columns=BED_COLS)
+    regdna_df = pd.DataFrame(
+        [['chr1', 500, 1500, 'gA', 0, '+'], ['chr1', 1500, 2500, 'gC', 0, '+'],
+        ['chr1', 2600, 3200, 'gB', 0, '-']],
+        columns=BED_COLS)
+    peak_df = pd.DataFrame(
+        [['chr1', 600, 900, '.', 1], ['chr1', 1400, 1700, '.', 2],
+        ['chr1', 1800, 1900, '.', 4], ['chr1', 2700, 2800, '.', 3]])
+    regdna_bed = pybedtools.BedTool(write_bed(regdna_df, tmp_path / 'regdna.bed'))
+    peak_fn = write_bed(peak_df, tmp_path / 'peak.bed')
+    genes = ['gA', 'gB', 'gC']
+
+    feat_arr_dict = {}
+    for backend in ['bedtools', 'numpy']:
+        tracks = list(dpu.generate_peak_tracks(
+            [('tf_binding', 'X', peak_fn)], regdna_bed, gene_df, genes, FEAT_COLS,
+            n_workers=1, intersect_backend=backend))
+        feat_arr = tracks[0][2]
+        feat_arr_dict[backend] = feat_arr[np.lexsort(feat_arr.T[::-1])]
+
+    assert feat_arr_dict['bedtools'].shape == (5, 4)
+    np.testing.assert_array_equal(feat_arr_dict['bedtools'], feat_arr_dict['numpy'])
+
+
+def test_indexed_genome_skips_missing_chrom(tmp_path):
+    genome_fa = tmp_path / 'genome.fa'
+    genome_fa.write_text('>chr1\nACGTACGTAC\nGTAC\n>chr2\nTTTT\n')
+    genome = dpu.IndexedGenome(str(genome_fa))
+
+    assert genome.fetch('chr1', 8, 12) == b'ACGT'
+    assert genome.fetch('chrM', 0, 10) == b''
+    assert genome.fetch_regions(['chr2', 'chrM', 'chr1'], [0, 0, 0], [2, 5, 3]) == \
+        [b'TT', b'', b'ACG']